@@ -1,54 +1,713 @@
-import sys, os, pickle
-from flask import Flask, request, jsonify
+import sys, os, pickle, threading, time, logging, hmac, gzip, json, signal, math
+import cProfile, pstats, tracemalloc
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
+import numpy as np
 import pandas as pd
 
+try:
+    import orjson
+except ImportError:
+    # Encodeur JSON rapide optionnel : repli sur le module json standard
+    orjson = None
+
+import metrics
+
 sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
-from REGLES import process_user_selection
+from REGLES import (process_user_selection, load_rules, find_rules, load_dataset, find_dataset,
+                    index_dataset, selection_key, file_digest, build_response,
+                    EXAMPLES_LIMIT, RESPONSE_FIELDS, EXAMPLE_FIELDS, build_count_cube, query_count_cube,
+                    build_spatial_index, query_nearby, build_cluster_pyramid, query_clusters)
 
 app = Flask(__name__)
 CORS(app)
 
-# Dataset
+# Chemins des artefacts
+# Dataset : .feather voisin (typé, mappé en mémoire) s'il existe, sinon le CSV
 dataset_path = os.path.join(os.path.dirname(__file__), '../data/meteorites_final_rebalanced.csv')
-df = pd.read_csv(dataset_path)
+# Règles : rules.bin (mappé en mémoire) s'il existe, sinon rules.pkl
+rules_dir = os.path.dirname(__file__)
+# Table de réponses précalculées (générée par generate_answers.py)
+answers_path = os.path.join(os.path.dirname(__file__), 'answers.pkl')
+
+# Cache des résultats (LRU borné)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+# Nombre maximal de sélections par appel à /predict/batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+# Intervalle (s) entre deux vérifications des artefacts sur disque
+ARTIFACT_CHECK_INTERVAL = float(os.environ.get("ARTIFACT_CHECK_INTERVAL", 1.0))
+# Rechargement des artefacts : "process" = chaque processus surveille et recharge
+# (serveur de dev) ; "master" = le maître gunicorn recharge puis relance ses
+# workers, qui partagent le nouvel instantané (positionné par gunicorn.conf.py)
+ARTIFACT_RELOAD = os.environ.get("ARTIFACT_RELOAD", "process")
+# Jeton des routes d'administration (en-tête X-Admin-Token) ; routes désactivées si absent
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# Dossier où sauvegarder les profils .prof de /predict?profile=1 (optionnel)
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+# Pagination des exemples : offset + limit maximal accepté
+MAX_EXAMPLES = int(os.environ.get("MAX_EXAMPLES", 500))
+# Nombre maximal de météorites retournées par /nearby
+MAX_NEARBY = int(os.environ.get("MAX_NEARBY", 500))
+# Nombre maximal de cellules de grille couvertes par une requête /clusters
+MAX_CLUSTER_CELLS = int(os.environ.get("MAX_CLUSTER_CELLS", 2000))
+# Taille (octets) à partir de laquelle les réponses JSON sont compressées en gzip
+GZIP_MIN_SIZE = int(os.environ.get("GZIP_MIN_SIZE", 1024))
+
+logger = logging.getLogger(__name__)
+
+
+def artifacts_signature():
+    """
+    Signature (chemin, mtime, taille) des règles, du dataset et de la table de
+    réponses, plus le CSV source : le modifier invalide aussi le .feather.
+    """
+    signature = []
+    for path in (find_rules(rules_dir), find_dataset(dataset_path), answers_path, dataset_path):
+        if not os.path.exists(path):
+            signature.append((path, None, None))
+            continue
+        st = os.stat(path)
+        signature.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+def load_answer_table(digest):
+    """
+    Charge la table de réponses précalculées si elle a été construite
+    à partir des mêmes règles et du même dataset, sinon retourne {}.
+    """
+    if not os.path.exists(answers_path):
+        return {}
+    with open(answers_path, 'rb') as f:
+        table = pickle.load(f)
+    if table.get("digest") != digest:
+        return {}
+    return table["answers"]
+
+
+def load_artifacts():
+    """
+    Charge le dataset et les règles, puis précalcule leurs structures dérivées.
+    Retourne un instantané complet et immuable du moteur : il n'est jamais
+    modifié, seulement remplacé d'un bloc lors d'un rechargement.
+    """
+    start = time.perf_counter()
+    signature = artifacts_signature()
+    rules_path, data_path = signature[0][0], signature[1][0]
+
+    # Dataset (colonnes utiles uniquement)
+    df = load_dataset(data_path)
+
+    # Règles compilées (masques, drapeaux, tri), mappées en mémoire si rules.bin
+    rules = load_rules(rules_path)
+
+    digest = file_digest(rules_path, data_path)
+
+    return {
+        "signature": signature,
+        "digest": digest,
+        "version": rules.attrs.get("version", digest),
+        "answers": load_answer_table(digest),
+        "df": df,
+        # Structures dérivées du dataset (index année -> période, ...)
+        "index": index_dataset(df),
+        # Structures propres à /stats, /nearby et /clusters
+        "count_cube": build_count_cube(df),
+        "spatial_index": build_spatial_index(df),
+        "cluster_pyramid": build_cluster_pyramid(df),
+        "rules": rules,
+        "loaded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "load_seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+engine = load_artifacts()
+
+_result_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# Calculs en cours par clé : les requêtes identiques concurrentes attendent le premier
+_in_flight = {}
+_reload_lock = threading.Lock()
+_watcher_lock = threading.Lock()
+reload_status = {"reloads": 0, "last_error": None}
+
+
+def reload_if_changed(force=False):
+    """
+    Construit un nouvel instantané si les artefacts ont changé sur disque,
+    puis le publie par une seule affectation (atomique) de `engine`.
+    Les requêtes en cours terminent sur l'instantané qu'elles ont lu.
+    En cas d'échec (fichier en cours d'écriture, ...), l'ancien instantané reste actif.
+    """
+    global engine
+    with _reload_lock:
+        if not force and artifacts_signature() == engine["signature"]:
+            return False
+        try:
+            snapshot = load_artifacts()
+        except Exception as e:
+            reload_status["last_error"] = f"{type(e).__name__}: {e}"
+            logger.exception("Échec du rechargement des artefacts")
+            return False
+        engine = snapshot
+        reload_status["reloads"] += 1
+        reload_status["last_error"] = None
+        with _cache_lock:
+            _result_cache.clear()
+        return True
+
+
+def _watch_artifacts():
+    while True:
+        time.sleep(ARTIFACT_CHECK_INTERVAL)
+        try:
+            reload_if_changed()
+        except Exception:
+            logger.exception("Échec de la surveillance des artefacts")
+
+
+def start_master_watcher(request_reload):
+    """
+    Surveillance côté maître gunicorn (ARTIFACT_RELOAD=master) : ne charge rien,
+    appelle `request_reload` (SIGHUP du maître) une fois par nouvelle signature.
+    Le rechargement lui-même a lieu dans le hook on_reload de gunicorn.conf.py.
+    """
+    def watch():
+        requested = None
+        while True:
+            time.sleep(ARTIFACT_CHECK_INTERVAL)
+            try:
+                signature = artifacts_signature()
+                if signature != engine["signature"] and signature != requested:
+                    requested = signature
+                    request_reload()
+            except Exception:
+                logger.exception("Échec de la surveillance des artefacts")
+
+    if ARTIFACT_CHECK_INTERVAL > 0:
+        threading.Thread(target=watch, name="artifact-watcher", daemon=True).start()
+
+
+_watcher_pid = None
+
+
+def ensure_watcher():
+    """
+    Démarre le thread de surveillance dans le processus courant. Appelé à chaque
+    requête : les threads ne survivent pas au fork des workers gunicorn.
+    Sous gunicorn (ARTIFACT_RELOAD=master), seul le maître surveille : un
+    rechargement par worker dupliquerait le dataset dans chacun.
+    """
+    global _watcher_pid
+    if ARTIFACT_RELOAD == "master" or _watcher_pid == os.getpid() or ARTIFACT_CHECK_INTERVAL <= 0:
+        return
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+        threading.Thread(target=_watch_artifacts, name="artifact-watcher", daemon=True).start()
+
+
+@app.before_request
+def _before_request():
+    ensure_watcher()
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    start = g.get("request_start")
+    if start is not None and request.endpoint != "metrics_endpoint":
+        endpoint = (("endpoint", request.endpoint or "unknown"),)
+        metrics.observe("meteor_request_latency_seconds", endpoint, time.perf_counter() - start)
+        metrics.inc("meteor_requests_total", endpoint + (("status", str(response.status_code)),))
+        if response.status_code >= 500:
+            metrics.inc("meteor_request_errors_total", endpoint)
+    return response
+
+
+def is_admin_request():
+    """Vrai si la requête porte le jeton d'administration configuré."""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def run_selection(sel, state, masks=None, max_examples=EXAMPLES_LIMIT, sample="first", examples=True):
+    """
+    Exécute process_user_selection sur un état chargé.
+    `masks` partage les masques de règles et du dataset au sein d'un lot.
+    """
+    index = state["index"] if masks is None else dict(state["index"], masks=masks)
+    timings = {}
+    result = process_user_selection(sel, state["rules"], state["df"], index=index, timings=timings,
+                                    max_examples=max_examples, sample=sample, examples=examples)
+    for stage, seconds in timings.items():
+        metrics.observe("meteor_stage_latency_seconds", (("stage", stage),), seconds)
+    return result
+
+
+def cached_process_user_selection(sel, state=None, masks=None, examples=True):
+    """
+    process_user_selection mémoïsé sur la clé canonique de la sélection.
+    Les sélections discrétisées sont d'abord cherchées dans la table précalculée.
+    Les règles filtrées (DataFrame) ne sont pas conservées dans le cache.
+    Les requêtes concurrentes de même clé partagent un seul calcul (single-flight).
+    `examples=False` : résultat sans exemples, mis en cache sous sa propre clé ;
+    un résultat complet déjà en cache le remplace.
+    """
+    if state is None:
+        state = engine
+    try:
+        sel_key = selection_key(sel)
+        precomputed = state["answers"].get(sel_key)
+        full_key = (state["signature"], sel_key)
+        key = full_key if examples else full_key + ("sans exemples",)
+    except (TypeError, ValueError):
+        # Sélection non canonisable : calcul direct, sans cache
+        return run_selection(sel, state, masks, examples=examples)
+
+    if precomputed is not None:
+        metrics.inc("meteor_cache_lookups_total", (("result", "precomputed"),))
+        return dict(precomputed, selection=sel)
+
+    with _cache_lock:
+        hit = full_key if full_key in _result_cache else key
+        cached = _result_cache.get(hit)
+        if cached is not None:
+            _result_cache.move_to_end(hit)
+            metrics.inc("meteor_cache_lookups_total", (("result", "hit"),))
+            return dict(cached, selection=sel)
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = {"done": threading.Event(), "entry": None, "error": None}
+            metrics.inc("meteor_cache_lookups_total", (("result", "miss"),))
+        else:
+            metrics.inc("meteor_cache_lookups_total", (("result", "coalesced"),))
+
+    if not leader:
+        # Même sélection déjà en calcul : attendre son résultat
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return dict(flight["entry"], selection=sel)
+
+    try:
+        result = run_selection(sel, state, masks, examples=examples)
+        entry = {k: v for k, v in result.items() if k != "filtered_rules"}
+        flight["entry"] = entry
+        with _cache_lock:
+            _result_cache[key] = entry
+            _result_cache.move_to_end(key)
+            while len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+    except BaseException as e:
+        flight["error"] = e
+        raise
+    finally:
+        # Toujours libérer la clé et réveiller les requêtes en attente,
+        # y compris si le worker est interrompu (timeout, arrêt)
+        with _cache_lock:
+            _in_flight.pop(key, None)
+        flight["done"].set()
+    return result
+
+def parse_selection(data):
+    """Extrait la sélection (années, masse, continents) d'un corps JSON."""
+    if not isinstance(data, dict):
+        raise ValueError("Une sélection doit être un objet JSON")
+    return {
+        "years": data.get("years"),
+        "mass": data.get("mass"),
+        "continents": data.get("continents")
+    }
+
+
+def profile_selection(sel, state, top=30, trace_memory=False):
+    """
+    Exécute process_user_selection (sans cache) sous cProfile et retourne
+    (résultat, rapport) : durée par étape, fonctions les plus coûteuses et,
+    si demandé, résumé des allocations tracemalloc.
+    """
+    timings = {}
+    profiler = cProfile.Profile()
+    trace_memory = trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        profiler.enable()
+        result = process_user_selection(sel, state["rules"], state["df"], index=state["index"], timings=timings)
+        profiler.disable()
+        if trace_memory:
+            memory_snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+    finally:
+        profiler.disable()
+        if trace_memory:
+            tracemalloc.stop()
+
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    report = {
+        "stages": {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+        "total_ms": round(sum(timings.values()) * 1000, 3),
+        "functions": [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({func})",
+                "ncalls": nc,
+                "tottime_ms": round(tt * 1000, 3),
+                "cumtime_ms": round(ct * 1000, 3)
+            }
+            for (filename, line, func), (cc, nc, tt, ct, callers) in rows
+        ]
+    }
+    if trace_memory:
+        report["memory"] = {
+            "current_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "top_allocations": [
+                {"location": str(stat.traceback), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in memory_snapshot.statistics("lineno")[:15]
+            ]
+        }
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"predict-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+        stats.dump_stats(path)
+        report["saved_to"] = path
+    return result, report
+
+
+def parse_shaping(args):
+    """
+    Paramètres de mise en forme de la réponse (query string) :
+    fields=top_type,probability  offset=0  limit=10  sample=first|stratified
+    Retourne (fields, offset, limit, sample) ; lève ValueError si invalides.
+    """
+    fields = None
+    if args.get("fields"):
+        fields = {field.strip() for field in args["fields"].split(",") if field.strip()}
+        unknown = fields - set(RESPONSE_FIELDS)
+        if unknown:
+            raise ValueError(f"Champs inconnus : {', '.join(sorted(unknown))}")
+    try:
+        offset = int(args.get("offset", 0))
+        limit = int(args["limit"]) if args.get("limit") is not None else None
+    except ValueError:
+        raise ValueError("offset et limit doivent être des entiers")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset et limit doivent être positifs")
+    if offset + (limit if limit is not None else 0) > MAX_EXAMPLES:
+        raise ValueError(f"offset + limit ne doit pas dépasser {MAX_EXAMPLES}")
+    sample = args.get("sample", "first")
+    if sample not in ("first", "stratified"):
+        raise ValueError("sample doit valoir 'first' ou 'stratified'")
+    return fields, offset, limit, sample
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type non sérialisable : {type(value).__name__}")
+
+
+def json_response(payload, status=200):
+    """
+    Réponse JSON encodée avec orjson s'il est installé, compressée en gzip
+    si le client l'accepte et que le corps dépasse GZIP_MIN_SIZE.
+    """
+    if orjson is not None:
+        body = orjson.dumps(payload, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"),
+                          default=_json_default).encode("utf-8")
+    response = Response(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(body) >= GZIP_MIN_SIZE and request.accept_encodings["gzip"] > 0:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def profiling_requested():
+    """Profilage demandé par ?profile=1 ou l'en-tête X-Profile: 1."""
+    return request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
 
-# Règles
-rules_path = os.path.join(os.path.dirname(__file__), 'rules.pkl')
-with open(rules_path, 'rb') as f:
-    rules = pickle.load(f)
 
 @app.route("/predict", methods=["POST"])
 def predict():
+    try:
+        fields, offset, limit, sample = parse_shaping(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
         data = request.get_json(force=True)
-        sel = {
-            "years": data.get("years"),
-            "mass": data.get("mass"),
-            "continents": data.get("continents")
-        }
-        result = process_user_selection(sel, rules, df)
-        
-        # Construire la réponse de base
-        response = {
-            "top_type": result["top_type"],
-            "probability": result["probability"],
-            "names": result["names"],
-            "countries": result["countries"],
-            "sample_years": result["sample_years"]
-        }
-        
-        # Toujours ajouter les prédictions - elles ne seront jamais None
-        if "predicted_years" in result:
-            response["predicted_years"] = result["predicted_years"]
-        if "predicted_mass" in result:
-            response["predicted_mass"] = result["predicted_mass"]
-        if "predicted_continent" in result:
-            response["predicted_continent"] = result["predicted_continent"]
-        
-        return jsonify(response)
+        sel = parse_selection(data)
+        if profiling_requested():
+            # Profilage à la demande, réservé aux administrateurs
+            if not is_admin_request():
+                return jsonify({"error": "Accès refusé"}), 403
+            trace_memory = request.args.get("tracemalloc") == "1"
+            result, report = profile_selection(sel, engine, trace_memory=trace_memory)
+            return json_response(dict(build_response(result, fields, offset, limit), profile=report))
+        needed = offset + (limit if limit is not None else EXAMPLES_LIMIT)
+        wants_examples = fields is None or "names" in fields or "sample_years" in fields
+        if wants_examples and (needed > EXAMPLES_LIMIT or sample != "first"):
+            # Page au-delà des exemples mis en cache ou échantillon stratifié : calcul direct
+            result = run_selection(sel, engine, max_examples=max(needed, EXAMPLES_LIMIT), sample=sample)
+        else:
+            examples = fields is None or not fields.isdisjoint(EXAMPLE_FIELDS)
+            result = cached_process_user_selection(sel, examples=examples)
+        return json_response(build_response(result, fields, offset, limit))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+
+@app.route("/predict/batch", methods=["POST"])
+def predict_batch():
+    """
+    Prédit une liste de sélections : {"selections": [{...}, ...]} ou [{...}, ...].
+    Les sélections de même clé canonique ne sont évaluées qu'une fois et les
+    masques de règles / du dataset sont partagés par tout le lot.
+    Les réponses suivent l'ordre d'entrée ; une erreur n'affecte que son élément.
+    fields / offset / limit / sample s'appliquent à chaque réponse, dans la limite
+    des EXAMPLES_LIMIT premiers exemples.
+    """
+    try:
+        fields, offset, limit, sample = parse_shaping(request.args)
+        if offset + (limit or 0) > EXAMPLES_LIMIT:
+            raise ValueError(f"offset + limit ne doit pas dépasser {EXAMPLES_LIMIT} pour un lot")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    data = request.get_json(force=True, silent=True)
+    selections = data.get("selections") if isinstance(data, dict) else data
+    if not isinstance(selections, list):
+        return jsonify({"error": "Le corps doit contenir une liste 'selections'"}), 400
+    if len(selections) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Lot trop grand : {len(selections)} > {MAX_BATCH_SIZE}"}), 400
+
+    state = engine
+    masks = {}
+    responses = [None] * len(selections)
+    examples = fields is None or not fields.isdisjoint(EXAMPLE_FIELDS)
+
+    # Regrouper les positions par clé canonique
+    groups = {}
+    for i, item in enumerate(selections):
+        try:
+            sel = parse_selection(item)
+            key = selection_key(sel)
+            hash(key)
+        except (TypeError, ValueError) as e:
+            if isinstance(item, dict):
+                # Sélection non canonisable : évaluée seule
+                key = ("item", i)
+            else:
+                responses[i] = {"error": str(e)}
+                continue
+        groups.setdefault(key, (sel, []))[1].append(i)
+
+    # Évaluer chaque sélection distincte une seule fois
+    for sel, positions in groups.values():
+        try:
+            if sample != "first":
+                result = run_selection(sel, state, masks, sample=sample)
+            else:
+                result = cached_process_user_selection(sel, state, masks, examples=examples)
+            response = build_response(result, fields, offset, limit)
+        except Exception as e:
+            response = {"error": str(e)}
+            metrics.inc("meteor_batch_item_errors_total", value=len(positions))
+        for i in positions:
+            responses[i] = response
+
+    return json_response({"results": responses})
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    Comptages du catalogue depuis le cube précalculé, sans parcourir le dataset :
+    /stats?by=recclass_clean,continent&continent=Asia,Africa&top=10
+    `by` : dimensions du regroupement ; toute autre dimension en paramètre
+    restreint le comptage à ces valeurs. `share` = part du total filtré.
+    """
+    cube = engine["count_cube"]
+    try:
+        by = [dim for dim in request.args.get("by", "").split(",") if dim]
+        where = {dim: request.args[dim].split(",") for dim in cube["dimensions"] if dim in request.args}
+        top = int(request.args["top"]) if request.args.get("top") else None
+        total, groups = query_count_cube(cube, by, where)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if top is not None and top < 0:
+        return jsonify({"error": "top doit être positif"}), 400
+    for group in groups:
+        group["share"] = round(group["count"] / total, 4) if total else 0.0
+    return json_response({
+        "total": total,
+        "by": by,
+        "filters": where,
+        "groups": groups[:top] if top is not None else groups
+    })
+
+NEARBY_COLUMNS = ['name', 'recclass', 'recclass_clean', 'year_period', 'year', 'mass_cleaned',
+                  'country', 'continent', 'reclat', 'reclong']
+
+
+@app.route("/nearby", methods=["GET"])
+def nearby():
+    """
+    Météorites tombées près d'un point, via l'index spatial :
+    /nearby?lat=48.85&lon=2.35&radius_km=200          (dans un rayon)
+    /nearby?lat=48.85&lon=2.35&k=10&recclass_clean=L6 (k plus proches)
+    Filtres optionnels : recclass_clean, year_period (valeurs séparées par des virgules).
+    """
+    args = request.args
+    try:
+        lat, lon = float(args["lat"]), float(args["lon"])
+        radius_km = float(args["radius_km"]) if args.get("radius_km") else None
+        k = int(args["k"]) if args.get("k") else None
+        limit = int(args.get("limit", MAX_NEARBY))
+    except KeyError:
+        return jsonify({"error": "lat et lon sont requis"}), 400
+    except ValueError:
+        return jsonify({"error": "Paramètres numériques invalides"}), 400
+    if not all(math.isfinite(v) for v in (lat, lon, radius_km if radius_km is not None else 0.0)):
+        return jsonify({"error": "lat, lon et radius_km doivent être finis"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"error": "Coordonnées hors limites"}), 400
+    if radius_km is None and k is None:
+        return jsonify({"error": "radius_km ou k est requis"}), 400
+    if (radius_km is not None and radius_km < 0) or (k is not None and k < 1) or limit < 0:
+        return jsonify({"error": "radius_km, k et limit doivent être positifs"}), 400
+
+    state = engine
+    types = args["recclass_clean"].split(",") if args.get("recclass_clean") else None
+    periods = args["year_period"].split(",") if args.get("year_period") else None
+    positions, distances = query_nearby(state["spatial_index"], lat, lon, radius_km=radius_km,
+                                        k=min(k, MAX_NEARBY) if k is not None else None,
+                                        types=types, periods=periods)
+
+    shown = min(limit, MAX_NEARBY)
+    rows = state["df"][NEARBY_COLUMNS].take(positions[:shown])
+    results = rows.astype(object).where(rows.notna(), None).to_dict("records")
+    for result, distance in zip(results, distances[:shown]):
+        result["distance_km"] = round(float(distance), 3)
+    return json_response({"count": len(positions), "results": results})
+
+@app.route("/clusters", methods=["GET"])
+def clusters():
+    """
+    Clusters de météorites pour la carte, en GeoJSON :
+    /clusters?bbox=ouest,sud,est,nord&zoom=5[&recclass_clean=L6,H5][&year_period=...]
+    Le zoom est abaissé si l'emprise couvre trop de cellules (réponse bornée).
+    """
+    args = request.args
+    try:
+        bbox = [float(v) for v in args["bbox"].split(",")]
+        zoom = int(args.get("zoom", 0))
+    except KeyError:
+        return jsonify({"error": "bbox est requis (ouest,sud,est,nord)"}), 400
+    except ValueError:
+        return jsonify({"error": "bbox et zoom doivent être numériques"}), 400
+    if len(bbox) != 4 or not (-180 <= bbox[0] <= 180 and -180 <= bbox[2] <= 180
+                              and -90 <= bbox[1] <= bbox[3] <= 90):
+        return jsonify({"error": "bbox invalide (ouest,sud,est,nord)"}), 400
+
+    state = engine
+    types = args["recclass_clean"].split(",") if args.get("recclass_clean") else None
+    periods = args["year_period"].split(",") if args.get("year_period") else None
+    effective_zoom, found = query_clusters(state["cluster_pyramid"], bbox, zoom,
+                                           types=types, periods=periods, max_cells=MAX_CLUSTER_CELLS)
+
+    df = state["df"]
+    features = []
+    for cluster in found:
+        properties = {"count": cluster["count"], "types": cluster["types"]}
+        if cluster["count"] == 1:
+            # Point isolé : détails de la météorite
+            row = df.iloc[cluster["row"]]
+            properties.update(name=row["name"], recclass=row["recclass"],
+                              year=None if pd.isna(row["year"]) else float(row["year"]),
+                              mass=None if pd.isna(row["mass_cleaned"]) else float(row["mass_cleaned"]))
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(cluster["lon"], 5), round(cluster["lat"], 5)]},
+            "properties": properties
+        })
+    return json_response({"type": "FeatureCollection", "zoom": effective_zoom, "features": features})
+
+METRIC_HELP = {
+    "meteor_request_latency_seconds": "Durée des requêtes HTTP par endpoint",
+    "meteor_requests_total": "Requêtes HTTP par endpoint et code de statut",
+    "meteor_request_errors_total": "Requêtes HTTP terminées en erreur 5xx",
+    "meteor_stage_latency_seconds": "Durée de chaque étape de process_user_selection",
+    "meteor_cache_lookups_total": "Résolutions de sélection (table précalculée, cache, calcul)",
+    "meteor_batch_item_errors_total": "Éléments de /predict/batch en erreur",
+    "meteor_cache_hit_ratio": "Part des sélections servies sans calcul",
+    "meteor_cache_entries": "Entrées du cache LRU de résultats (processus ayant répondu)",
+    "meteor_engine_info": "Version des artefacts actifs",
+}
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Métriques au format texte Prometheus."""
+    merged = metrics.snapshot()
+    served = metrics.counter_value(merged, "meteor_cache_lookups_total", result="precomputed") \
+        + metrics.counter_value(merged, "meteor_cache_lookups_total", result="hit") \
+        + metrics.counter_value(merged, "meteor_cache_lookups_total", result="coalesced")
+    total = served + metrics.counter_value(merged, "meteor_cache_lookups_total", result="miss")
+    state = engine
+    gauges = [
+        ("meteor_cache_hit_ratio", (), served / total if total else 0.0),
+        ("meteor_cache_entries", (), len(_result_cache)),
+        ("meteor_engine_info", (("version", state["version"]), ("digest", state["digest"])), 1),
+    ]
+    body = metrics.render(merged, METRIC_HELP, gauges)
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/engine", methods=["GET"])
+def admin_engine():
+    """Version active du moteur, date et durée de chargement."""
+    if not is_admin_request():
+        return jsonify({"error": "Accès refusé"}), 403
+    state = engine
+    return jsonify({
+        "version": state["version"],
+        "digest": state["digest"],
+        "rules_path": state["signature"][0][0],
+        "dataset_path": state["signature"][1][0],
+        "rules": len(state["rules"]),
+        "rows": len(state["df"]),
+        "precomputed_answers": len(state["answers"]),
+        "loaded_at": state["loaded_at"],
+        "load_seconds": state["load_seconds"],
+        "reloads": reload_status["reloads"],
+        "last_error": reload_status["last_error"]
+    })
+
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """Force la reconstruction de l'instantané (hors chemin des requêtes /predict)."""
+    if not is_admin_request():
+        return jsonify({"error": "Accès refusé"}), 403
+    if ARTIFACT_RELOAD == "master":
+        # Le maître gunicorn recharge puis relance les workers (voir gunicorn.conf.py)
+        os.kill(os.getppid(), signal.SIGHUP)
+        return jsonify({"reloaded": False, "requested": True, "version": engine["version"]}), 202
+    swapped = reload_if_changed(force=True)
+    return jsonify({"reloaded": swapped, "version": engine["version"],
+                    "loaded_at": engine["loaded_at"], "last_error": reload_status["last_error"]})
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5001)
\ No newline at end of file
+    # Serveur de développement ; en production : gunicorn -c gunicorn.conf.py app:app
+    # Le reloader est désactivé : il rechargerait règles et dataset dans un second processus
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", use_reloader=False, threaded=True,
+            host="0.0.0.0", port=int(os.environ.get("PORT", 5001)))
\ No newline at end of file
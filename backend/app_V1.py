@@ -1,6 +1,9 @@
 from flask import Flask, request, jsonify
 import json
 import os
+import heapq
+from functools import lru_cache
+from itertools import combinations, islice
 import folium
 
 app = Flask(__name__)
@@ -8,6 +11,12 @@ app = Flask(__name__)
 # ---- PATH RULES FILE ----
 RULES_PATH = os.path.join(os.path.dirname(__file__), "rules", "rules.json")
 
+# ---- MAP SETTINGS ----
+# rendered folium maps kept in memory (one per rule)
+MAP_CACHE_SIZE = int(os.environ.get("MAP_CACHE_SIZE", 256))
+# render every rule's map at startup instead of on first use
+PRERENDER_MAPS = os.environ.get("PRERENDER_MAPS") == "1"
+
 # ---- LOAD RULES ----
 def load_rules():
     if os.path.exists(RULES_PATH):
@@ -17,6 +26,24 @@ def load_rules():
 
 RULES = load_rules()
 
+
+# ---- INDEX RULES ----
+def rule_rank(entry):
+    # best first: confidence, then lift, then file order (same order as choose_best)
+    position, r = entry
+    return (-r.get("confidence", 0), -r.get("lift", 0), position)
+
+def index_rules(rules):
+    """Rules bucketed by frozen antecedent, each bucket pre-sorted by rule_rank."""
+    index = {}
+    for position, r in enumerate(rules):
+        index.setdefault(frozenset(r.get("antecedent", [])), []).append((position, r))
+    for bucket in index.values():
+        bucket.sort(key=rule_rank)
+    return index
+
+RULES_INDEX = index_rules(RULES)
+
 # ---- RECLASS FUNCTION ----
 def convert_to_transaction(year, continent, mass):
 
@@ -61,14 +88,22 @@ def convert_to_transaction(year, continent, mass):
 
 
 # ---- MATCH RULES ----
-def match_rules(transaction, rules):
+def match_rules(transaction, rules_index, limit=None):
+    """
+    Rules whose antecedent is a subset of the transaction, best first,
+    as (position in rules.json, rule) pairs.
+    One hash lookup per subset of the transaction (2^3 for a 3-token
+    transaction), then a merge of the pre-sorted buckets up to `limit`.
+    """
     tset = set(transaction)
-    matches = []
-    for r in rules:
-        antecedent = set(r.get("antecedent", []))
-        if antecedent <= tset:  # subset
-            matches.append(r)
-    return matches
+    buckets = []
+    for size in range(len(tset) + 1):
+        for subset in combinations(tset, size):
+            bucket = rules_index.get(frozenset(subset))
+            if bucket:
+                buckets.append(bucket[:limit])
+    merged = heapq.merge(*buckets, key=rule_rank)
+    return list(islice(merged, limit))
 
 # ---- SELECT BEST RULE ----
 def choose_best(matches):
@@ -98,6 +133,33 @@ def generate_map(points):
     return m._repr_html_()
 
 
+@lru_cache(maxsize=MAP_CACHE_SIZE)
+def rule_map_html(position):
+    # same rule -> same proof points -> same map: render once
+    # keyed on the position in rules.json: a rule's own "id" may not be unique
+    return generate_map(RULES[position].get("examples", []))
+
+
+def points_geojson(points):
+    # proof points for client-side rendering
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [p["lon"], p["lat"]]},
+                "properties": {"name": p.get("name", "")}
+            }
+            for p in points
+        ]
+    }
+
+
+if PRERENDER_MAPS:
+    for position in range(min(len(RULES), MAP_CACHE_SIZE)):
+        rule_map_html(position)
+
+
 # ---- API ROUTE ----
 @app.route("/predict", methods=["POST"])
 def predict():
@@ -106,10 +168,14 @@ def predict():
     year = data.get("year")
     continent = data.get("continent")
     mass = data.get("mass")
+    # "html" (default): folium map, "geojson": points only, "none": no map
+    map_format = data.get("map", "html")
 
     transaction = convert_to_transaction(year, continent, mass)
 
-    matches = match_rules(transaction, RULES)
+    # only the top 3 are ever used
+    entries = match_rules(transaction, RULES_INDEX, limit=3)
+    matches = [r for _, r in entries]
 
     if not matches:
         return jsonify({
@@ -130,8 +196,9 @@ def predict():
     # proof points
     proof = best.get("examples", [])
 
-    # make folium map
-    map_html = generate_map(proof)
+    # map: cached per rule, or GeoJSON for the client
+    best_position = next(position for position, r in entries if r is best)
+    map_html = rule_map_html(best_position) if map_format == "html" else ""
 
     # format top3
     top3_fmt = []
@@ -139,14 +206,18 @@ def predict():
         c = r["consequent"][0].replace("type_", "")
         top3_fmt.append([c, r["confidence"]])
 
-    return jsonify({
+    response = {
         "pred_type": typ,
         "confidence": best.get("confidence", 0),
         "lift": best.get("lift", 0),
         "top3": top3_fmt,
         "proof_points": proof,
         "map_html": map_html
-    })
+    }
+    if map_format == "geojson":
+        response["map_geojson"] = points_geojson(proof)
+
+    return jsonify(response)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+# build_dataset_artifact.py
+import sys
+import os
+import time
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
+from REGLES import save_dataset_artifact, load_dataset
+
+# -----------------------------
+# Convertir le dataset nettoyé en Feather (colonnes typées, mappable)
+# -----------------------------
+dataset_path = os.path.join(os.path.dirname(__file__), '../data/meteorites_final_rebalanced.csv')
+artifact_path = os.path.splitext(dataset_path)[0] + '.feather'
+
+df = pd.read_csv(dataset_path)
+save_dataset_artifact(df, artifact_path, source_path=dataset_path)
+
+start = time.perf_counter()
+load_dataset(dataset_path)
+csv_time = time.perf_counter() - start
+
+start = time.perf_counter()
+loaded = load_dataset(artifact_path)
+feather_time = time.perf_counter() - start
+
+print(f"Dataset converti : {len(loaded)} lignes")
+print(f"   📦 CSV     : {os.path.getsize(dataset_path) / 1024:.0f} Ko, chargé en {csv_time * 1000:.0f} ms")
+print(f"   📦 Feather : {os.path.getsize(artifact_path) / 1024:.0f} Ko, chargé en {feather_time * 1000:.0f} ms")
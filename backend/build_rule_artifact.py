@@ -0,0 +1,23 @@
+# build_rule_artifact.py
+import sys
+import os
+import pickle
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
+from REGLES import save_rule_artifact, load_rule_artifact
+
+# -----------------------------
+# Convertir rules.pkl en artefact colonnaire rules.bin
+# -----------------------------
+rules_path = os.path.join(os.path.dirname(__file__), 'rules.pkl')
+artifact_path = os.path.join(os.path.dirname(__file__), 'rules.bin')
+
+with open(rules_path, 'rb') as f:
+    rules = pickle.load(f)
+
+version = save_rule_artifact(rules, artifact_path, source_path=rules_path)
+loaded = load_rule_artifact(artifact_path)
+
+print(f"Règles converties : {len(loaded)} (version {version})")
+print(f"   📦 rules.pkl : {os.path.getsize(rules_path) / 1024:.1f} Ko")
+print(f"   📦 rules.bin : {os.path.getsize(artifact_path) / 1024:.1f} Ko")
@@ -0,0 +1,57 @@
+# generate_answers.py
+import sys
+import os
+import pickle
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
+from REGLES import load_rules, find_rules, load_dataset, find_dataset, index_dataset, build_answer_table, file_digest
+
+# -----------------------------
+# Charger dataset et règles
+# -----------------------------
+# Même dataset que le backend : .feather s'il existe, sinon le CSV
+dataset_path = find_dataset(os.path.join(os.path.dirname(__file__), '../data/meteorites_final_rebalanced.csv'))
+# Mêmes règles que le backend : rules.bin s'il existe, sinon rules.pkl
+rules_path = find_rules(os.path.dirname(__file__))
+
+df = load_dataset(dataset_path)
+rules = load_rules(rules_path)
+
+print(f"Dataset chargé : {len(df)} lignes")
+print(f"Règles chargées : {len(rules)}")
+
+# -----------------------------
+# Évaluer toutes les sélections discrétisées
+# -----------------------------
+start = time.perf_counter()
+answers = build_answer_table(rules, df, index=index_dataset(df))
+elapsed = time.perf_counter() - start
+
+print(f"Sélections évaluées : {len(answers)} en {elapsed:.1f}s")
+
+# -----------------------------
+# Combinaisons sans aucune règle
+# -----------------------------
+empty = [answer['selection'] for answer in answers.values() if answer['rules_count'] == 0]
+print(f"\nCombinaisons sans règle : {len(empty)}")
+for sel in empty:
+    print(f"  - années={sel['years']} | masse={sel['mass']} | continents={sel['continents']}")
+
+# -----------------------------
+# Sauvegarder la table
+# -----------------------------
+# L'empreinte lie la table aux règles et au dataset utilisés pour la construire
+answers_path = os.path.join(os.path.dirname(__file__), 'answers.pkl')
+with open(answers_path, 'wb') as f:
+    pickle.dump({
+        'digest': file_digest(rules_path, dataset_path),
+        'answers': answers,
+        'empty': empty
+    }, f)
+
+print("\n" + "="*60)
+print("✅ Fichier answers.pkl créé avec succès !")
+print(f"   📊 SÉLECTIONS : {len(answers)}")
+print(f"   ⚠️ SANS RÈGLE : {len(empty)}")
+print("="*60)
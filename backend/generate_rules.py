@@ -3,6 +3,10 @@ import pandas as pd
 from mlxtend.frequent_patterns import apriori, association_rules
 import pickle
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
+from REGLES import save_rule_artifact
 
 # -----------------------------
 # Charger dataset
@@ -213,7 +217,12 @@ rules_path = os.path.join(os.path.dirname(__file__), 'rules.pkl')
 with open(rules_path, 'wb') as f:
     pickle.dump(rules, f)
     print(f"\n" + "="*60)
+
+# Artefact colonnaire mappable en mémoire, chargé par le backend
+artifact_path = os.path.join(os.path.dirname(__file__), 'rules.bin')
+artifact_version = save_rule_artifact(rules, artifact_path, source_path=rules_path)
 print("✅ Fichier rules.pkl créé avec succès !")
+print(f"✅ Fichier rules.bin créé (version {artifact_version})")
 print(f"   📊 TOTAL RÈGLES : {len(rules)}")
 print(f"   ✅ CONFIDENCE MOYENNE : {rules['confidence'].mean():.3f}")
 print(f"   🎯 LIFT MOYEN : {rules['lift'].mean():.3f}")
@@ -0,0 +1,85 @@
+# gunicorn.conf.py
+"""
+Mode production du backend (sans serveur de debug ni reloader) :
+
+    cd backend && gunicorn -c gunicorn.conf.py app:app
+
+Les règles et le dataset sont chargés une seule fois dans le processus
+maître (preload_app), puis partagés en copy-on-write par les workers forkés.
+
+Rechargement des artefacts : seul le maître surveille rules.bin / dataset.
+Quand ils changent (ou sur POST /admin/reload, ou `kill -HUP <maître>`), le
+maître reconstruit l'instantané puis gunicorn relance tous ses workers : ils
+partagent à nouveau le même instantané et servent tous la même version.
+
+Métriques : chaque worker écrit ses totaux dans METRICS_DIR (répertoire
+temporaire par défaut) ; /metrics, quel que soit le worker qui répond,
+additionne ceux de tous les workers (voir metrics.py).
+
+Variables d'environnement :
+    PORT             port d'écoute (5001 par défaut)
+    WEB_CONCURRENCY  nombre de workers (processus), 2 par défaut
+    WEB_THREADS      threads par worker, 4 par défaut
+    WEB_TIMEOUT      délai maximal d'une requête en secondes, 60 par défaut
+    METRICS_DIR      répertoire des métriques partagées entre workers
+"""
+import gc
+import os
+import signal
+import sys
+import tempfile
+
+# Lu par app.py au preload : les workers ne rechargent pas eux-mêmes
+os.environ.setdefault("ARTIFACT_RELOAD", "master")
+# Lu par metrics.py : un fichier de métriques par worker (créé une seule fois,
+# ce fichier de configuration étant réexécuté à chaque SIGHUP)
+if "METRICS_DIR" not in os.environ:
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="meteor-metrics-")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("WEB_TIMEOUT", 60))
+
+# Charger app.py (règles + dataset + index) dans le maître avant le fork
+preload_app = True
+reload = False
+
+
+def _backend(server):
+    # Module app.py déjà importé par le preload
+    return sys.modules[server.app.wsgi().import_name]
+
+
+def on_starting(server):
+    # Métriques d'une exécution précédente (METRICS_DIR fourni)
+    _backend(server).metrics.clear_files()
+
+
+def when_ready(server):
+    # Geler les objets déjà chargés : le ramasse-miettes ne les parcourt plus,
+    # ce qui évite de dupliquer leurs pages mémoire dans chaque worker
+    gc.freeze()
+    # Un changement d'artefact déclenche SIGHUP : le maître recharge (on_reload)
+    # puis gunicorn remplace les workers
+    _backend(server).start_master_watcher(lambda: os.kill(os.getpid(), signal.SIGHUP))
+
+
+def on_reload(server):
+    # Appelé par le maître sur SIGHUP, avant de forker les nouveaux workers
+    _backend(server).reload_if_changed(force=True)
+    gc.unfreeze()
+    gc.collect()
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Derniers totaux du worker (dans le worker, avant sa sortie)
+    _backend(server).metrics.flush()
+
+
+def child_exit(server, worker):
+    # Dans le maître : replier le fichier du worker terminé dans retired.pkl,
+    # y compris s'il a été tué sans passer par worker_exit
+    _backend(server).metrics.retire(worker.pid)
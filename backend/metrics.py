@@ -0,0 +1,258 @@
+# metrics.py
+"""
+Métriques du backend au format texte Prometheus.
+
+Chaque thread écrit dans ses propres compteurs (aucun verrou sur le chemin
+des requêtes) ; l'export /metrics additionne les compteurs de tous les threads.
+Les compteurs des threads terminés sont repliés dans un agrégat commun.
+
+Avec plusieurs processus (workers gunicorn), METRICS_DIR désigne un répertoire
+partagé : chaque processus y écrit ses totaux (<pid>.pkl) toutes les
+METRICS_FLUSH_INTERVAL secondes et à sa sortie, et l'export additionne les
+fichiers de tous les processus. Le fichier d'un worker terminé est replié dans
+retired.pkl (voir retire) : les compteurs ne redescendent pas après un
+rechargement et le nombre de fichiers lus reste borné.
+"""
+import contextlib
+import bisect
+import logging
+import os
+import pickle
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Bornes (secondes) des histogrammes de latence
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1.0))
+# Totaux cumulés des workers terminés
+RETIRED_FILE = "retired.pkl"
+
+_local = threading.local()
+_shards = []
+_retired = {"histograms": {}, "counters": {}}
+_registry_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _reset_after_fork():
+    # Un worker forké repart de zéro : les mesures du parent sont dans son propre fichier
+    global _local, _shards, _retired, _registry_lock
+    _local = threading.local()
+    _shards = []
+    _retired = {"histograms": {}, "counters": {}}
+    _registry_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _new_histogram():
+    # [comptes par bucket (+Inf en dernier), somme, nombre]
+    return [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = {"thread": threading.current_thread(), "histograms": {}, "counters": {}}
+        # Verrou uniquement à la première mesure d'un thread
+        with _registry_lock:
+            _shards.append(shard)
+        _local.shard = shard
+        _ensure_flusher()
+    return shard
+
+
+def observe(name, labels, seconds):
+    """Enregistre une durée dans l'histogramme `name` (labels : tuple de paires)."""
+    histograms = _shard()["histograms"]
+    key = (name, labels)
+    hist = histograms.get(key)
+    if hist is None:
+        hist = histograms[key] = _new_histogram()
+    hist[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    hist[1] += seconds
+    hist[2] += 1
+
+
+def inc(name, labels=(), value=1):
+    """Incrémente le compteur `name`."""
+    counters = _shard()["counters"]
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def _merge_into(target, shard):
+    for key, (buckets, total, count) in list(shard["histograms"].items()):
+        hist = target["histograms"].setdefault(key, _new_histogram())
+        hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+        hist[1] += total
+        hist[2] += count
+    for key, value in list(shard["counters"].items()):
+        target["counters"][key] = target["counters"].get(key, 0) + value
+
+
+def _process_snapshot():
+    """Somme des compteurs et histogrammes de tous les threads du processus."""
+    with _registry_lock:
+        # Replier les threads terminés (serveur de dev : un thread par requête)
+        for shard in [s for s in _shards if not s["thread"].is_alive()]:
+            _merge_into(_retired, shard)
+            _shards.remove(shard)
+        merged = {"histograms": {}, "counters": {}}
+        _merge_into(merged, _retired)
+        for shard in _shards:
+            _merge_into(merged, shard)
+    return merged
+
+
+@contextlib.contextmanager
+def _dir_lock(exclusive):
+    """Verrou sur METRICS_DIR : un worker n'est jamais lu à la fois dans son fichier et dans retired.pkl."""
+    import fcntl
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_file(name):
+    try:
+        with open(os.path.join(METRICS_DIR, name), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError):
+        logger.warning("Fichier de métriques illisible : %s", name)
+        return None
+
+
+def _write_file(name, totals):
+    # Remplacement atomique : un lecteur ne voit jamais un fichier partiel
+    path = os.path.join(METRICS_DIR, name)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(totals, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def snapshot():
+    """
+    Somme des compteurs et histogrammes de tous les threads et, avec
+    METRICS_DIR, des derniers totaux des autres processus et des workers terminés.
+    """
+    merged = _process_snapshot()
+    if METRICS_DIR:
+        own = f"{os.getpid()}.pkl"
+        with _dir_lock(exclusive=False):
+            for name in os.listdir(METRICS_DIR):
+                if not name.endswith(".pkl") or name == own:
+                    continue
+                totals = _read_file(name)
+                if totals is not None:
+                    _merge_into(merged, totals)
+    return merged
+
+
+def flush():
+    """Écrit les totaux du processus dans METRICS_DIR/<pid>.pkl."""
+    if not METRICS_DIR:
+        return
+    _write_file(f"{os.getpid()}.pkl", _process_snapshot())
+
+
+def retire(pid):
+    """
+    Replie les derniers totaux du processus `pid` (terminé) dans retired.pkl
+    et supprime son fichier. Appelé par le maître gunicorn (child_exit).
+    """
+    if not METRICS_DIR:
+        return
+    with _dir_lock(exclusive=True):
+        totals = _read_file(f"{pid}.pkl")
+        if totals is None:
+            return
+        retired = _read_file(RETIRED_FILE) or {"histograms": {}, "counters": {}}
+        _merge_into(retired, totals)
+        _write_file(RETIRED_FILE, retired)
+        os.remove(os.path.join(METRICS_DIR, f"{pid}.pkl"))
+
+
+def clear_files():
+    """Supprime les fichiers de METRICS_DIR (démarrage du serveur)."""
+    if not METRICS_DIR:
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith((".pkl", ".pkl.tmp")):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Échec de l'écriture des métriques")
+
+
+def _ensure_flusher():
+    """Démarre l'écriture périodique dans le processus courant (une fois par pid)."""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    with _registry_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flusher", daemon=True).start()
+
+
+def counter_value(merged, name, **labels):
+    """Somme d'un compteur sur les séries dont les labels correspondent."""
+    return sum(value for (n, lbls), value in merged["counters"].items()
+               if n == name and all(dict(lbls).get(k) == v for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(merged, help_texts, gauges=()):
+    """
+    Texte d'exposition Prometheus. `gauges` : liste de (nom, labels, valeur).
+    """
+    lines = []
+    by_name = {}
+    for (name, labels), hist in merged["histograms"].items():
+        by_name.setdefault(("histogram", name), []).append((labels, hist))
+    for (name, labels), value in merged["counters"].items():
+        by_name.setdefault(("counter", name), []).append((labels, value))
+    for name, labels, value in gauges:
+        by_name.setdefault(("gauge", name), []).append((labels, value))
+
+    for (kind, name), series in sorted(by_name.items(), key=lambda item: item[0][1]):
+        if name in help_texts:
+            lines.append(f"# HELP {name} {help_texts[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(series, key=lambda item: item[0]):
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            buckets, total, count = value
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,206 @@
+# score_bulk.py
+"""
+Score en masse un fichier de sélections (CSV ou NDJSON) sans lancer Flask.
+
+Chaque ligne d'entrée contient les champs years / mass / continents
+(en CSV : cellules JSON, ex. "[[1990, 2000]]", ou valeur simple "Asia").
+Les résultats sont écrits au fil de l'eau en NDJSON, dans l'ordre d'entrée.
+
+    python score_bulk.py selections.csv -o scores.ndjson --workers 8
+"""
+import sys
+import os
+import csv
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../training'))
+from REGLES import (process_user_selection, load_rules, find_rules, load_dataset, find_dataset,
+                    index_dataset, selection_key, build_response)
+
+DEFAULT_DATASET = find_dataset(os.path.join(os.path.dirname(__file__), '../data/meteorites_final_rebalanced.csv'))
+DEFAULT_RULES = find_rules(os.path.dirname(__file__))
+
+# Taille du cache de résultats propre à chaque worker
+WORKER_CACHE_SIZE = 4096
+
+# -----------------------------
+# État des workers (chargé une seule fois par processus)
+# -----------------------------
+_worker = {}
+
+
+def init_worker(rules_path, dataset_path):
+    """Charge les règles et le dataset une fois par processus worker."""
+    df = load_dataset(dataset_path)
+    rules = load_rules(rules_path)
+    _worker.update(rules=rules, df=df, index=index_dataset(df), cache={})
+
+
+def score_selection(sel):
+    """Score une sélection, avec un cache local au worker sur la clé canonique."""
+    cache = _worker['cache']
+    try:
+        key = selection_key(sel)
+        cached = cache.get(key)
+    except (TypeError, ValueError):
+        key, cached = None, None
+    if cached is not None:
+        return cached
+
+    result = process_user_selection(sel, _worker['rules'], _worker['df'], index=_worker['index'])
+    response = build_response(result)
+    if key is not None and len(cache) < WORKER_CACHE_SIZE:
+        cache[key] = response
+    return response
+
+
+def score_chunk(chunk):
+    """
+    Score un paquet de (numéro de ligne, sélection) et retourne les lignes NDJSON.
+    Les lignes illisibles ({'row': n, 'error': ...}) sont recopiées telles quelles.
+    """
+    lines = []
+    for item in chunk:
+        if isinstance(item, dict):
+            lines.append(json.dumps(item, ensure_ascii=False))
+            continue
+        row, sel = item
+        try:
+            out = {'row': row, 'selection': sel}
+            out.update(score_selection(sel))
+        except Exception as e:
+            out = {'row': row, 'selection': sel, 'error': str(e)}
+        lines.append(json.dumps(out, ensure_ascii=False, default=_json_default))
+    return lines
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type non sérialisable : {type(value).__name__}")
+
+# -----------------------------
+# Lecture des sélections
+# -----------------------------
+def _parse_cell(value):
+    """Cellule CSV -> valeur de sélection (liste) ou None si vide."""
+    if value is None or value.strip() == '':
+        return None
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        parsed = value.strip()
+    if parsed is None or isinstance(parsed, list):
+        return parsed
+    return [parsed]
+
+
+def read_selections(stream, fmt):
+    """
+    Générateur de (numéro de ligne, sélection) pour un flux CSV ou NDJSON.
+    Une ligne NDJSON illisible donne {'row': n, 'error': ...} sans arrêter la lecture.
+    """
+    if fmt == 'csv':
+        for row, record in enumerate(csv.DictReader(stream)):
+            yield row, {field: _parse_cell(record.get(field)) for field in ('years', 'mass', 'continents')}
+    else:
+        row = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield {'row': row, 'error': f"JSON invalide : {e}"}
+            else:
+                if isinstance(record, dict):
+                    yield row, {field: record.get(field) for field in ('years', 'mass', 'continents')}
+                else:
+                    yield {'row': row, 'error': "Une sélection doit être un objet JSON"}
+            row += 1
+
+
+def chunked(items, size):
+    """Regroupe un itérable en listes de `size` éléments, sans tout charger."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# -----------------------------
+# Pipeline principal
+# -----------------------------
+def run(stream, out, fmt, workers, chunk_size, rules_path, dataset_path, report_every=5.0):
+    """
+    Distribue les paquets aux workers en gardant au plus 2 paquets en vol
+    par worker (mémoire bornée) et écrit les résultats dans l'ordre d'entrée.
+    """
+    start = last_report = time.perf_counter()
+    done = 0
+    pending = deque()
+    max_in_flight = 2 * workers
+
+    def report(final=False):
+        elapsed = time.perf_counter() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        label = "Terminé" if final else "En cours"
+        print(f"{label} : {done} lignes en {elapsed:.1f}s ({rate:.0f} lignes/s)", file=sys.stderr)
+
+    def drain_one():
+        nonlocal done, last_report
+        lines = pending.popleft().result()
+        out.write('\n'.join(lines) + '\n')
+        done += len(lines)
+        if time.perf_counter() - last_report >= report_every:
+            last_report = time.perf_counter()
+            report()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(rules_path, dataset_path)) as pool:
+        for chunk in chunked(read_selections(stream, fmt), chunk_size):
+            if len(pending) >= max_in_flight:
+                drain_one()
+            pending.append(pool.submit(score_chunk, chunk))
+        while pending:
+            drain_one()
+
+    out.flush()
+    report(final=True)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score en masse des sélections (CSV/NDJSON -> NDJSON).")
+    parser.add_argument('input', help="Fichier CSV ou NDJSON de sélections ('-' pour stdin)")
+    parser.add_argument('-o', '--output', default='-', help="Fichier NDJSON de sortie ('-' pour stdout)")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help="Format d'entrée (déduit de l'extension par défaut)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Nombre de processus workers")
+    parser.add_argument('--chunk-size', type=int, default=256, help="Sélections par paquet envoyé à un worker")
+    parser.add_argument('--rules', default=DEFAULT_RULES, help="Chemin des règles (rules.bin ou rules.pkl)")
+    parser.add_argument('--dataset', default=DEFAULT_DATASET, help="Chemin du dataset (.feather ou .csv)")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ('csv' if args.input.lower().endswith('.csv') else 'ndjson')
+    stream = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        run(stream, out, fmt, max(1, args.workers), max(1, args.chunk_size), args.rules, args.dataset)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
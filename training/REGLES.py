@@ -1,5 +1,13 @@
 # meteorite_functions.py
 
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import time
+import warnings
+from collections.abc import Hashable
 import pandas as pd
 import numpy as np
 import folium
@@ -29,50 +37,885 @@ def is_geographic_tautology(row):
 def is_type_prediction_rule(row):
     return any('recclass_clean_' in str(item) for item in row['consequents'])
 
+# -----------------------------
+# Compiler les antécédents en masques binaires
+# -----------------------------
+def compile_rules(rules):
+    """
+    Encode chaque antécédent en masque binaire (un bit par item one-hot)
+    et précalcule les drapeaux is_tautology / is_type_rule, le type prédit
+    (consequent_type) et son code entier (type_code, -1 sans type).
+    Les règles sont triées une fois pour toutes par (confidence, lift)
+    décroissants : tout sous-ensemble filtré sort donc déjà trié.
+    Le vocabulaire {item: bit} est conservé dans rules.attrs['item_bits'].
+    À appeler une seule fois au chargement de rules.pkl.
+    """
+    rules = rules.sort_values(by=['confidence', 'lift'], ascending=[False, False], kind='mergesort')
+    items = sorted({str(item) for ants in rules['antecedents'] for item in ants})
+    if len(items) > 64:
+        raise ValueError(f"Vocabulaire trop grand pour un masque 64 bits : {len(items)} items")
+    item_bits = {item: np.uint64(1) << np.uint64(i) for i, item in enumerate(items)}
+
+    masks = np.zeros(len(rules), dtype=np.uint64)
+    for i, ants in enumerate(rules['antecedents']):
+        for item in ants:
+            masks[i] |= item_bits[str(item)]
+
+    rules['antecedent_mask'] = masks
+    rules['is_tautology'] = rules.apply(is_geographic_tautology, axis=1).astype(bool)
+    rules['is_type_rule'] = rules.apply(is_type_prediction_rule, axis=1).astype(bool)
+    rules['consequent_type'] = rules['consequents'].apply(_consequent_type)
+    rules['type_code'] = pd.factorize(rules['consequent_type'], sort=True)[0]
+    rules.attrs['item_bits'] = item_bits
+    return rules
+
+def _criteria_mask(item_bits, user_criteria):
+    """
+    Convertit les critères utilisateur en masque binaire.
+    Retourne aussi si un critère est absent du vocabulaire des règles.
+    """
+    mask = np.uint64(0)
+    unknown = False
+    for item in user_criteria:
+        bit = item_bits.get(item)
+        if bit is None:
+            unknown = True
+        else:
+            mask |= bit
+    return mask, unknown
+
+# -----------------------------
+# Artefact de règles colonnaire (mappable en mémoire)
+# -----------------------------
+RULE_ARTIFACT_MAGIC = b'RULESV1\0'
+RULE_ARTIFACT_FORMAT = 1
+
+def _csr_items(itemsets, item_ids):
+    """Ensembles d'items -> (indptr, ids) au format CSR."""
+    indptr = np.zeros(len(itemsets) + 1, dtype=np.int32)
+    ids = []
+    for i, itemset in enumerate(itemsets):
+        row = sorted(item_ids[str(item)] for item in itemset)
+        ids.extend(row)
+        indptr[i + 1] = indptr[i] + len(row)
+    return indptr, np.asarray(ids, dtype=np.int16)
+
+def save_rule_artifact(rules, path, source_path=None):
+    """
+    Écrit les règles au format colonnaire : en-tête JSON (vocabulaire,
+    version, position des tableaux) puis tableaux alignés sur 64 octets.
+    Antécédents / conséquents en CSR d'identifiants d'items, métriques en float32,
+    plus les colonnes précalculées par compile_rules (masque, drapeaux, type).
+    `source_path` (rules.pkl d'origine) : son empreinte est gardée dans l'en-tête
+    pour que find_rules détecte un artefact périmé.
+    Retourne la version (empreinte du contenu).
+    """
+    compiled = compile_rules(rules)
+    vocab = sorted({str(item) for col in ('antecedents', 'consequents')
+                    for itemset in compiled[col] for item in itemset})
+    item_ids = {item: i for i, item in enumerate(vocab)}
+    mask_items = sorted(compiled.attrs['item_bits'], key=lambda item: int(compiled.attrs['item_bits'][item]))
+
+    ant_indptr, ant_items = _csr_items(compiled['antecedents'], item_ids)
+    cons_indptr, cons_items = _csr_items(compiled['consequents'], item_ids)
+    types = compiled['consequent_type']
+    consequent_type = np.array([item_ids[f'recclass_clean_{t}'] if isinstance(t, str) else -1 for t in types],
+                               dtype=np.int16)
+    arrays = {
+        'rule_id': compiled.index.to_numpy(dtype=np.int64),
+        'antecedent_indptr': ant_indptr,
+        'antecedent_items': ant_items,
+        'consequent_indptr': cons_indptr,
+        'consequent_items': cons_items,
+        'support': compiled['support'].to_numpy(dtype=np.float32),
+        'confidence': compiled['confidence'].to_numpy(dtype=np.float32),
+        'lift': compiled['lift'].to_numpy(dtype=np.float32),
+        'antecedent_mask': compiled['antecedent_mask'].to_numpy(dtype=np.uint64),
+        'is_tautology': compiled['is_tautology'].to_numpy(dtype=np.uint8),
+        'is_type_rule': compiled['is_type_rule'].to_numpy(dtype=np.uint8),
+        'consequent_type': consequent_type
+    }
+
+    h = hashlib.sha256(json.dumps([vocab, mask_items]).encode('utf-8'))
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        h.update(name.encode('utf-8'))
+        h.update(array.tobytes())
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset += -(-array.nbytes // 64) * 64
+    version = h.hexdigest()[:16]
+
+    header = json.dumps({
+        'format': RULE_ARTIFACT_FORMAT,
+        'version': version,
+        'n_rules': len(compiled),
+        'vocab': vocab,
+        'mask_items': mask_items,
+        'source_digest': file_digest(source_path) if source_path else None,
+        'arrays': layout
+    }).encode('utf-8')
+    # Début des données aligné sur 64 octets
+    data_start = -(-(len(RULE_ARTIFACT_MAGIC) + 8 + len(header)) // 64) * 64
+    header = header.ljust(data_start - len(RULE_ARTIFACT_MAGIC) - 8)
+
+    # Écriture dans un fichier temporaire puis remplacement atomique :
+    # les processus qui mappent l'ancienne version ne voient jamais un fichier tronqué
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(RULE_ARTIFACT_MAGIC)
+        f.write(np.array(len(header), dtype='<u8').tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][1])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return version
+
+def load_rule_artifact(path, with_itemsets=False):
+    """
+    Charge un artefact écrit par save_rule_artifact par mappage mémoire :
+    les colonnes numériques sont des vues en lecture seule sur le fichier,
+    partagées entre processus. Retourne un DataFrame déjà compilé
+    (équivalent à compile_rules) ; attrs['version'] identifie l'artefact.
+    Avec with_itemsets=True, les colonnes antecedents / consequents
+    (frozensets) sont reconstruites pour un usage hors backend.
+    """
+    mm = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(mm[:len(RULE_ARTIFACT_MAGIC)]) != RULE_ARTIFACT_MAGIC:
+        raise ValueError(f"{path} n'est pas un artefact de règles")
+    header_len = int(np.frombuffer(mm, dtype='<u8', count=1, offset=len(RULE_ARTIFACT_MAGIC))[0])
+    header_start = len(RULE_ARTIFACT_MAGIC) + 8
+    header = json.loads(bytes(mm[header_start:header_start + header_len]))
+    if header['format'] != RULE_ARTIFACT_FORMAT:
+        raise ValueError(f"Format d'artefact non supporté : {header['format']}")
+    data_start = header_start + header_len
+
+    arrays = {
+        name: np.frombuffer(mm, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+        for name, (dtype, offset, count) in header['arrays'].items()
+    }
+    vocab = np.array(header['vocab'], dtype=object)
+    type_names = np.array([item.replace('recclass_clean_', '') for item in header['vocab']] + [None],
+                          dtype=object)
+
+    rules = pd.DataFrame({
+        'support': arrays['support'],
+        'confidence': arrays['confidence'],
+        'lift': arrays['lift'],
+        'antecedent_mask': arrays['antecedent_mask'],
+        'is_tautology': arrays['is_tautology'].view(bool),
+        'is_type_rule': arrays['is_type_rule'].view(bool),
+        # -1 (pas de type) pointe sur le None final
+        'consequent_type': type_names[arrays['consequent_type']],
+        # Identifiant d'item du type comme code entier (voir rank_types)
+        'type_code': arrays['consequent_type']
+    }, index=pd.Index(arrays['rule_id']), copy=False)
+
+    if with_itemsets:
+        for col, prefix in (('antecedents', 'antecedent'), ('consequents', 'consequent')):
+            indptr, items = arrays[f'{prefix}_indptr'], arrays[f'{prefix}_items']
+            rules[col] = [frozenset(vocab[items[indptr[i]:indptr[i + 1]]]) for i in range(len(rules))]
+
+    rules.attrs['item_bits'] = {item: np.uint64(1) << np.uint64(i) for i, item in enumerate(header['mask_items'])}
+    rules.attrs['version'] = header['version']
+    return rules
+
+def read_rule_artifact_header(path):
+    """En-tête JSON d'un artefact de règles, sans mapper les tableaux."""
+    with open(path, 'rb') as f:
+        if f.read(len(RULE_ARTIFACT_MAGIC)) != RULE_ARTIFACT_MAGIC:
+            raise ValueError(f"{path} n'est pas un artefact de règles")
+        header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        return json.loads(f.read(header_len))
+
+# Dernière vérification par (source, artefact) : (état des fichiers, artefact à jour ?)
+_artifact_freshness = {}
+
+def _artifact_is_fresh(artifact_path, source_path, read_source_digest):
+    """
+    L'artefact (rules.bin, .feather) correspond-il à sa source (rules.pkl, CSV) ?
+    Seulement vérifié si la source est plus récente : son empreinte est comparée
+    à celle que `read_source_digest(artifact_path)` lit dans l'artefact.
+    """
+    source_stat, artifact_stat = os.stat(source_path), os.stat(artifact_path)
+    if source_stat.st_mtime_ns <= artifact_stat.st_mtime_ns:
+        return True
+    state = (source_stat.st_mtime_ns, source_stat.st_size, artifact_stat.st_mtime_ns, artifact_stat.st_size)
+    checked = _artifact_freshness.get((source_path, artifact_path))
+    if checked is None or checked[0] != state:
+        try:
+            source_digest = read_source_digest(artifact_path)
+        except (OSError, ValueError):
+            source_digest = None
+        checked = (state, source_digest == file_digest(source_path))
+        _artifact_freshness[(source_path, artifact_path)] = checked
+    return checked[1]
+
+def _rule_artifact_source(path):
+    return read_rule_artifact_header(path).get('source_digest')
+
+def find_rules(directory):
+    """
+    Chemin des règles à charger : rules.bin s'il existe et correspond à rules.pkl,
+    sinon rules.pkl (avec un avertissement si rules.bin est périmé).
+    """
+    artifact_path = os.path.join(directory, 'rules.bin')
+    pickle_path = os.path.join(directory, 'rules.pkl')
+    if not os.path.exists(artifact_path):
+        return pickle_path
+    if os.path.exists(pickle_path) and not _artifact_is_fresh(artifact_path, pickle_path, _rule_artifact_source):
+        warnings.warn(f"{artifact_path} est plus ancien que {pickle_path} et n'en provient pas : "
+                      "rules.pkl est utilisé (relancer build_rule_artifact.py)")
+        return pickle_path
+    return artifact_path
+
+def load_rules(path):
+    """
+    Charge des règles compilées : artefact colonnaire (.bin, mappé en mémoire)
+    ou DataFrame picklé par generate_rules.py (.pkl, compilé au chargement).
+    """
+    if path.endswith('.bin'):
+        return load_rule_artifact(path)
+    with open(path, 'rb') as f:
+        return compile_rules(pickle.load(f))
+
+# -----------------------------
+# Dataset colonnaire (Feather)
+# -----------------------------
+# Colonnes utilisées par le backend (projection au chargement)
+DATASET_COLUMNS = ['name', 'year_period', 'year', 'recclass', 'continent', 'country',
+                   'mass_cleaned', 'mass_bin', 'recclass_clean', 'reclat', 'reclong']
+CATEGORICAL_COLUMNS = ['year_period', 'mass_bin', 'continent', 'country', 'recclass_clean']
+
+def _has_pyarrow():
+    try:
+        import pyarrow.feather  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def save_dataset_artifact(df, path, source_path=None):
+    """
+    Écrit le dataset nettoyé au format Feather non compressé (mappable en mémoire),
+    avec des colonnes catégorielles pour les critères. Nécessite pyarrow.
+    `source_path` (CSV d'origine) : son empreinte est gardée dans les métadonnées
+    du schéma pour que find_dataset détecte un artefact périmé.
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    typed = df.reset_index(drop=True)
+    for col in CATEGORICAL_COLUMNS:
+        if col in typed.columns:
+            typed[col] = typed[col].astype('category')
+    table = pa.Table.from_pandas(typed, preserve_index=None)
+    if source_path:
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'source_digest'] = file_digest(source_path).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+    tmp_path = f'{path}.tmp'
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+def _dataset_artifact_source(path):
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    digest = metadata.get(b'source_digest')
+    return digest.decode('utf-8') if digest is not None else None
+
+def find_dataset(csv_path):
+    """
+    Dataset à charger : le fichier .feather voisin du CSV s'il est lisible et
+    correspond au CSV, sinon le CSV (avec un avertissement si le .feather est périmé).
+    """
+    feather_path = os.path.splitext(csv_path)[0] + '.feather'
+    if not (os.path.exists(feather_path) and _has_pyarrow()):
+        return csv_path
+    if os.path.exists(csv_path) and not _artifact_is_fresh(feather_path, csv_path, _dataset_artifact_source):
+        warnings.warn(f"{feather_path} est plus ancien que {csv_path} et n'en provient pas : "
+                      "le CSV est utilisé (relancer build_dataset_artifact.py)")
+        return csv_path
+    return feather_path
+
+def load_dataset(path, columns=DATASET_COLUMNS):
+    """
+    Charge le dataset avec projection de colonnes : Feather mappé en mémoire,
+    ou CSV en repli. Les colonnes de critères sont catégorielles dans les deux cas.
+    """
+    if path.endswith('.feather'):
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+    present = set(pd.read_csv(path, nrows=0).columns)
+    return pd.read_csv(path, usecols=[c for c in columns if c in present],
+                       dtype={c: 'category' for c in CATEGORICAL_COLUMNS if c in present})
+
+# -----------------------------
+# Index année -> période
+# -----------------------------
+def build_year_index(df):
+    """
+    Construit un index trié des années du dataset, compressé en plages
+    contiguës de même période. Une année ou une plage d'années se traduit
+    alors en périodes par recherche dichotomique.
+    """
+    year_to_period = df[['year', 'year_period']].dropna(subset=['year'])
+    year_to_period = year_to_period.drop_duplicates('year', keep='last').sort_values('year')
+    years = year_to_period['year'].to_numpy(dtype=float)
+    periods = year_to_period['year_period'].to_numpy(dtype=object)
+
+    # Début de chaque plage de périodes identiques
+    if len(periods):
+        changes = np.flatnonzero(periods[1:] != periods[:-1]) + 1
+        run_starts = np.concatenate(([0], changes))
+    else:
+        run_starts = np.array([], dtype=int)
+
+    return {
+        'years': years,
+        'run_starts': run_starts,
+        'run_periods': periods[run_starts].tolist()
+    }
+
+def _periods_in_range(year_index, start_year, end_year):
+    """Périodes couvertes par les années du dataset comprises dans [start, end]."""
+    years = year_index['years']
+    lo = np.searchsorted(years, start_year, side='left')
+    hi = np.searchsorted(years, end_year, side='right')
+    if lo >= hi:
+        return []
+    run_starts = year_index['run_starts']
+    first = np.searchsorted(run_starts, lo, side='right') - 1
+    last = np.searchsorted(run_starts, hi - 1, side='right') - 1
+    return year_index['run_periods'][first:last + 1]
+
+def _year_periods(year_index, years):
+    """Périodes couvertes par la sélection d'années (voir _year_intervals)."""
+    periods = set()
+    for start_year, end_year in _year_intervals(years):
+        periods.update(_periods_in_range(year_index, start_year, end_year))
+    periods.discard(None)
+    return periods
+
+# -----------------------------
+# Pays distincts par (type, continent)
+# -----------------------------
+def build_country_lists(df):
+    """
+    Pays distincts (hors NaN) par (type, continent), (type, None) et (None, continent),
+    avec la position de leur première ligne : {clé: (positions, pays)}.
+    Les positions permettent de fusionner plusieurs continents dans l'ordre du dataset.
+    """
+    frame = pd.DataFrame({
+        'type': df['recclass_clean'].to_numpy(),
+        'continent': df['continent'].to_numpy(),
+        'country': df['country'].to_numpy(),
+        'position': np.arange(len(df))
+    })
+    frame = frame[frame['country'].notna()]
+
+    lists = {}
+    for keys in (['type', 'continent'], ['type'], ['continent']):
+        firsts = frame.drop_duplicates(keys + ['country'])
+        for group, rows in firsts.groupby(keys, sort=False):
+            if len(keys) == 2:
+                key = group
+            elif keys == ['type']:
+                key = (group[0], None)
+            else:
+                key = (None, group[0])
+            lists[key] = (rows['position'].to_numpy(), rows['country'].tolist())
+    return lists
+
+def _lookup_countries(country_lists, top_type, continents):
+    """
+    Pays distincts, dans l'ordre de première apparition, des lignes du type
+    `top_type` (None = tous) situées dans `continents` (None = tous).
+    """
+    if continents is None:
+        return list(country_lists.get((top_type, None), ((), []))[1])
+    parts = [country_lists[(top_type, c)] for c in dict.fromkeys(continents) if (top_type, c) in country_lists]
+    if len(parts) == 1:
+        return list(parts[0][1])
+    first_seen = {}
+    for positions, countries in parts:
+        for position, country in zip(positions, countries):
+            if country not in first_seen or position < first_seen[country]:
+                first_seen[country] = position
+    return sorted(first_seen, key=first_seen.get)
+
+# -----------------------------
+# Cube de comptages (type, année, masse, continent)
+# -----------------------------
+def _cube_axis(values):
+    """
+    Étiquettes d'un axe du cube (ordre de tri de Series.mode) et code de chaque
+    ligne ; les valeurs manquantes ont le code len(étiquettes).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        labels = list(values.cat.categories)
+        codes = values.cat.codes.to_numpy()
+    else:
+        labels = sorted(values.dropna().unique().tolist())
+        codes = pd.Categorical(values, categories=labels).codes
+    return labels, np.where(codes < 0, len(labels), codes).astype(np.int64)
+
+def build_criteria_cube(df):
+    """
+    Nombre de lignes par (recclass_clean, (year, year_period), mass_bin, continent).
+    Les modes de predict_missing_criteria se calculent alors par sommes sur ce
+    cube, sans filtrer le dataset.
+    """
+    types, type_codes = _cube_axis(df['recclass_clean'])
+    years, year_codes = _cube_axis(df['year'])
+    periods, period_codes = _cube_axis(df['year_period'])
+    masses, mass_codes = _cube_axis(df['mass_bin'])
+    continents, continent_codes = _cube_axis(df['continent'])
+
+    # Axe "année" : couples (année, période) présents dans le dataset
+    stride = len(periods) + 1
+    pair_codes, pairs = pd.factorize(year_codes * stride + period_codes)
+    pair_year, pair_period = pairs // stride, pairs % stride
+
+    counts = np.zeros((len(types) + 1, len(pairs), len(masses) + 1, len(continents) + 1), dtype=np.int32)
+    np.add.at(counts, (type_codes, pair_codes, mass_codes, continent_codes), 1)
+
+    return {
+        'counts': counts,
+        'types': {label: i for i, label in enumerate(types)},
+        'pair_period': pair_period,
+        'periods': periods,
+        'masses': masses,
+        'mass_codes': {label: i for i, label in enumerate(masses)},
+        'continents': continents,
+        'continent_codes': {label: i for i, label in enumerate(continents)},
+        'overall': counts.sum(axis=0),
+        # Année de chaque couple (NaN pour les années manquantes ou non entières)
+        'pair_year': np.array([years[y] if y < len(years) and float(years[y]).is_integer() else np.nan
+                               for y in pair_year], dtype=float),
+        # Codes par ligne (couple, masse, continent) pour les filtres hors cube
+        'row_codes': (pair_codes.astype(np.int64), mass_codes, continent_codes),
+    }
+
+# -----------------------------
+# Cube de comptages creux (statistiques)
+# -----------------------------
+COUNT_CUBE_DIMENSIONS = ('recclass_clean', 'year_period', 'mass_bin', 'continent', 'country')
+
+def build_count_cube(df, dimensions=COUNT_CUBE_DIMENSIONS):
+    """
+    Cube creux des comptages : une ligne par combinaison de valeurs présente
+    dans le dataset. `labels[dim][code]` donne la valeur d'un code (le dernier
+    code, None, correspond aux valeurs manquantes).
+    """
+    labels = {}
+    codes = []
+    for dim in dimensions:
+        dim_labels, dim_codes = _cube_axis(df[dim])
+        labels[dim] = dim_labels + [None]
+        codes.append(dim_codes)
+    cells, counts = np.unique(np.column_stack(codes), axis=0, return_counts=True)
+    return {
+        'dimensions': list(dimensions),
+        'labels': labels,
+        'lookup': {dim: {label: i for i, label in enumerate(labels[dim])} for dim in dimensions},
+        'cells': cells,
+        'counts': counts
+    }
+
+def query_count_cube(cube, by=(), where=None):
+    """
+    Comptages du cube restreints par `where` ({dimension: [valeurs]}, slice/dice)
+    et agrégés sur les dimensions `by` (roll-up des autres).
+    Retourne (total, groupes triés par effectif décroissant).
+    """
+    where = where or {}
+    dimensions = cube['dimensions']
+    unknown = [dim for dim in list(by) + list(where) if dim not in dimensions]
+    if unknown:
+        raise ValueError(f"Dimensions inconnues : {', '.join(unknown)}")
+
+    cells, counts = cube['cells'], cube['counts']
+    if where:
+        keep = np.ones(len(counts), dtype=bool)
+        for dim, values in where.items():
+            lookup = cube['lookup'][dim]
+            allowed = np.zeros(len(lookup), dtype=bool)
+            allowed[[lookup[v] for v in values if v in lookup]] = True
+            keep &= allowed[cells[:, dimensions.index(dim)]]
+        cells, counts = cells[keep], counts[keep]
+    total = int(counts.sum())
+    if not by:
+        return total, []
+
+    # Clé entière unique par groupe (base mixte), puis somme par clé
+    sizes = [len(cube['labels'][dim]) for dim in by]
+    keys = np.zeros(len(counts), dtype=np.int64)
+    for dim, size in zip(by, sizes):
+        keys = keys * size + cells[:, dimensions.index(dim)]
+    sums = np.bincount(keys, weights=counts, minlength=int(np.prod(sizes)))
+    present = np.flatnonzero(sums)
+    groups = []
+    for key in present[np.argsort(-sums[present], kind='stable')]:
+        codes = np.unravel_index(key, sizes)
+        group = {dim: cube['labels'][dim][code] for dim, code in zip(by, codes)}
+        group['count'] = int(sums[key])
+        groups.append(group)
+    return total, groups
+
+# -----------------------------
+# Index spatial (grille lat/long)
+# -----------------------------
+EARTH_RADIUS_KM = 6371.0088
+
+def build_spatial_index(df, cell_deg=1.0):
+    """
+    Grille régulière de `cell_deg` degrés sur (reclat, reclong) : les lignes sont
+    triées par cellule et `cell_starts` donne le début de chaque cellule.
+    Les lignes sans coordonnées ne sont pas indexées.
+    """
+    lat = df['reclat'].to_numpy(dtype=float)
+    lon = df['reclong'].to_numpy(dtype=float)
+    rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    n_lat, n_lon = int(np.ceil(180 / cell_deg)), int(np.ceil(360 / cell_deg))
+    cells = _grid_cell(lat[rows], lon[rows], cell_deg, n_lat, n_lon)
+    order = np.argsort(cells, kind='stable')
+    rows, cells = rows[order], cells[order]
+
+    types, type_codes = _cube_axis(df['recclass_clean'])
+    periods, period_codes = _cube_axis(df['year_period'])
+    return {
+        'cell_deg': cell_deg,
+        'shape': (n_lat, n_lon),
+        'rows': rows,
+        'cell_starts': np.searchsorted(cells, np.arange(n_lat * n_lon + 1)),
+        'lat': np.radians(lat[rows]),
+        'lon': np.radians(lon[rows]),
+        'type_codes': type_codes[rows],
+        'types': {label: i for i, label in enumerate(types)},
+        'period_codes': period_codes[rows],
+        'periods': {label: i for i, label in enumerate(periods)}
+    }
+
+def _grid_cell(lat, lon, cell_deg, n_lat, n_lon):
+    i = np.clip(((np.asarray(lat) + 90) // cell_deg).astype(np.int64), 0, n_lat - 1)
+    j = ((np.asarray(lon) + 180) // cell_deg).astype(np.int64) % n_lon
+    return i * n_lon + j
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    """Distance (km) sur la sphère entre des points en radians."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _radius_candidates(spatial, lat, lon, radius_km):
+    """Positions (dans l'ordre de l'index) des cellules recoupant le cercle."""
+    cell_deg = spatial['cell_deg']
+    n_lat, n_lon = spatial['shape']
+    starts = spatial['cell_starts']
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = np.degrees(angle)
+    lat_lo, lat_hi = lat - dlat, lat + dlat
+    if lat_lo <= -90 or lat_hi >= 90 or angle >= np.pi / 2:
+        # Le cercle contient un pôle : toutes les longitudes
+        dlon = 180.0
+    else:
+        dlon = np.degrees(np.arcsin(min(1.0, np.sin(angle) / np.cos(np.radians(lat)))))
+    i_lo = max(0, int((lat_lo + 90) // cell_deg))
+    i_hi = min(n_lat - 1, int((lat_hi + 90) // cell_deg))
+
+    if dlon >= 180:
+        spans = [(0, n_lon - 1)]
+    else:
+        j_lo = int((lon - dlon + 180) // cell_deg)
+        j_hi = int((lon + dlon + 180) // cell_deg)
+        if j_hi - j_lo + 1 >= n_lon:
+            spans = [(0, n_lon - 1)]
+        elif j_lo < 0:
+            spans = [(0, j_hi), (j_lo % n_lon, n_lon - 1)]
+        elif j_hi >= n_lon:
+            spans = [(j_lo, n_lon - 1), (0, j_hi % n_lon)]
+        else:
+            spans = [(j_lo, j_hi)]
+
+    parts = [np.arange(starts[i * n_lon + a], starts[i * n_lon + b + 1])
+             for i in range(i_lo, i_hi + 1) for a, b in spans]
+    return np.concatenate(parts) if parts else np.array([], dtype=np.int64)
+
+def query_nearby(spatial, lat, lon, radius_km=None, k=None, types=None, periods=None):
+    """
+    Météorites proches de (lat, lon) : dans un rayon de `radius_km`, et/ou les
+    `k` plus proches, éventuellement restreintes à des types / périodes.
+    Retourne (positions des lignes du dataset, distances en km), par distance croissante.
+    """
+    if radius_km is None and k is None:
+        raise ValueError("radius_km ou k est requis")
+    lat_r, lon_r = np.radians(lat), np.radians(lon)
+
+    def within(radius):
+        found = _radius_candidates(spatial, lat, lon, radius)
+        for values, codes, lookup in ((types, 'type_codes', 'types'), (periods, 'period_codes', 'periods')):
+            if values:
+                allowed = np.zeros(len(spatial[lookup]) + 1, dtype=bool)
+                allowed[[spatial[lookup][v] for v in values if v in spatial[lookup]]] = True
+                found = found[allowed[spatial[codes][found]]]
+        distances = _haversine_km(lat_r, lon_r, spatial['lat'][found], spatial['lon'][found])
+        keep = distances <= radius
+        return found[keep], distances[keep]
+
+    if k is None:
+        found, distances = within(radius_km)
+    else:
+        # Rayon doublé jusqu'à contenir k points (ou tout le globe)
+        limit = radius_km if radius_km is not None else np.pi * EARTH_RADIUS_KM
+        radius = min(limit, 50.0)
+        while True:
+            found, distances = within(radius)
+            if len(found) >= k or radius >= limit:
+                break
+            radius = min(limit, radius * 4)
+
+    order = np.argsort(distances, kind='stable')
+    if k is not None:
+        order = order[:k]
+    return spatial['rows'][found[order]], distances[order]
+
+# -----------------------------
+# Pyramide de clusters par niveau de zoom (cartes)
+# -----------------------------
+CLUSTER_MAX_ZOOM = 14
+# Cellules de regroupement par côté de tuile (256 px -> cellules de 32 px)
+CLUSTER_CELLS_PER_TILE = 8
+MERCATOR_MAX_LAT = 85.05112878
+
+def _mercator_cells(lat, lon, n):
+    """Cellule (x, y) d'une grille n x n en projection Web Mercator."""
+    lat = np.radians(np.clip(lat, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    x = np.floor((np.asarray(lon) + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+def build_cluster_pyramid(df, max_zoom=CLUSTER_MAX_ZOOM, cells_per_tile=CLUSTER_CELLS_PER_TILE):
+    """
+    Pour chaque zoom, regroupe les météorites par (cellule de grille, type, période) :
+    effectif, somme des latitudes / longitudes (centroïde) et une ligne représentative.
+    Les groupes sont triés par (y, x) pour extraire une emprise par recherche binaire.
+    """
+    lat = df['reclat'].to_numpy(dtype=float)
+    lon = df['reclong'].to_numpy(dtype=float)
+    rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    lat, lon = lat[rows], lon[rows]
+    types, type_codes = _cube_axis(df['recclass_clean'])
+    periods, period_codes = _cube_axis(df['year_period'])
+    n_types, n_periods = len(types) + 1, len(periods) + 1
+    split = type_codes[rows] * n_periods + period_codes[rows]
+
+    levels = []
+    for zoom in range(max_zoom + 1):
+        n = (2 ** zoom) * cells_per_tile
+        x, y = _mercator_cells(lat, lon, n)
+        keys = (y * n + x) * (n_types * n_periods) + split
+        groups, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        cell, group_split = np.divmod(groups, n_types * n_periods)
+        levels.append({
+            'n': n,
+            'y': cell // n,
+            'x': cell % n,
+            'type': group_split // n_periods,
+            'period': group_split % n_periods,
+            'count': np.bincount(inverse, minlength=len(groups)),
+            'sum_lat': np.bincount(inverse, weights=lat, minlength=len(groups)),
+            'sum_lon': np.bincount(inverse, weights=lon, minlength=len(groups)),
+            'row': rows[first]
+        })
+    return {
+        'levels': levels,
+        'cells_per_tile': cells_per_tile,
+        'types': types + [None],
+        'type_lookup': {label: i for i, label in enumerate(types)},
+        'period_lookup': {label: i for i, label in enumerate(periods)}
+    }
+
+def _bbox_cell_ranges(bbox, n):
+    """Plages de cellules [(x0, x1)] et (y0, y1) couvrant bbox = (ouest, sud, est, nord)."""
+    west, south, east, north = bbox
+    (x_west, x_east), (y_north, y_south) = _mercator_cells(np.array([north, south]), np.array([west, east]), n)
+    if west > east:
+        # Emprise à cheval sur l'antiméridien
+        x_ranges = [(x_west, n - 1), (0, x_east)]
+    else:
+        x_ranges = [(x_west, x_east)]
+    return x_ranges, (y_north, y_south)
+
+def query_clusters(pyramid, bbox, zoom, types=None, periods=None, max_cells=2000):
+    """
+    Clusters visibles dans `bbox` (ouest, sud, est, nord) au niveau `zoom`,
+    agrégés par cellule sur les types / périodes demandés. Le zoom est abaissé
+    tant que l'emprise couvre plus de `max_cells` cellules : la réponse reste bornée.
+    Retourne (zoom effectif, liste de clusters).
+    """
+    zoom = int(min(max(zoom, 0), len(pyramid['levels']) - 1))
+    while True:
+        level = pyramid['levels'][zoom]
+        x_ranges, (y0, y1) = _bbox_cell_ranges(bbox, level['n'])
+        cells = sum(x1 - x0 + 1 for x0, x1 in x_ranges) * (y1 - y0 + 1)
+        if cells <= max_cells or zoom == 0:
+            break
+        zoom -= 1
+
+    lo, hi = np.searchsorted(level['y'], [y0, y1 + 1])
+    x = level['x'][lo:hi]
+    keep = np.zeros(hi - lo, dtype=bool)
+    for x0, x1 in x_ranges:
+        keep |= (x >= x0) & (x <= x1)
+    for values, column, lookup in ((types, 'type', 'type_lookup'), (periods, 'period', 'period_lookup')):
+        if values:
+            allowed = np.zeros(len(pyramid[lookup]) + 1, dtype=bool)
+            allowed[[pyramid[lookup][v] for v in values if v in pyramid[lookup]]] = True
+            keep &= allowed[level[column][lo:hi]]
+    selected = lo + np.flatnonzero(keep)
+    if len(selected) == 0:
+        return zoom, []
+
+    # Agréger les groupes (type, période) de chaque cellule
+    cell_keys = level['y'][selected] * level['n'] + level['x'][selected]
+    cell_ids, inverse = np.unique(cell_keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=level['count'][selected]).astype(np.int64)
+    sum_lat = np.bincount(inverse, weights=level['sum_lat'][selected])
+    sum_lon = np.bincount(inverse, weights=level['sum_lon'][selected])
+
+    clusters = [{'count': int(count), 'lat': lat / count, 'lon': lon / count, 'types': {}}
+                for count, lat, lon in zip(counts, sum_lat, sum_lon)]
+    for cell, group in zip(inverse, selected):
+        by_type = clusters[cell]['types']
+        label = pyramid['types'][level['type'][group]]
+        by_type[label] = by_type.get(label, 0) + int(level['count'][group])
+        clusters[cell].setdefault('row', int(level['row'][group]))
+    return zoom, clusters
+
+# -----------------------------
+# Index d'intervalles (année, masse)
+# -----------------------------
+RANGE_COLUMNS = ('year', 'mass_cleaned')
+
+def build_range_index(df, columns=RANGE_COLUMNS):
+    """
+    Pour chaque colonne numérique : valeurs triées et permutation des lignes,
+    pour tout le dataset (clé None) et pour chaque recclass_clean.
+    Un filtre d'intervalle se réduit alors à deux recherches binaires.
+    Les années non entières ne sont pas indexées (aucune sélection ne les vise).
+    """
+    types = df['recclass_clean'].to_numpy()
+    range_index = {}
+    for column in columns:
+        values = df[column].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        if column == 'year':
+            valid &= values == np.floor(values)
+        rows = np.flatnonzero(valid)
+        rows = rows[np.argsort(values[rows], kind='stable')]
+        entries = {None: (values[rows], rows)}
+        for label, positions in pd.Series(np.arange(len(rows))).groupby(types[rows], sort=False):
+            type_rows = rows[positions.to_numpy()]
+            entries[label] = (values[type_rows], type_rows)
+        range_index[column] = entries
+    range_index['size'] = len(df)
+    return range_index
+
+def _range_rows(range_index, column, intervals, top_type=None):
+    """Lignes (positions) dont `column` est dans l'un des intervalles [min, max] fermés."""
+    values, rows = range_index[column].get(top_type, ((), np.array([], dtype=np.int64)))
+    parts = [rows[np.searchsorted(values, lo, 'left'):np.searchsorted(values, hi, 'right')]
+             for lo, hi in intervals]
+    if not parts:
+        return np.array([], dtype=np.int64)
+    return parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts))
+
+def _range_mask(range_index, column, intervals, masks=None):
+    """Masque booléen des lignes dans les intervalles, mémorisé dans `masks` si fourni."""
+    key = ('range', column, tuple(intervals))
+    mask = masks.get(key) if masks is not None else None
+    if mask is None:
+        mask = np.zeros(range_index['size'], dtype=bool)
+        mask[_range_rows(range_index, column, intervals)] = True
+        if masks is not None:
+            masks[key] = mask
+    return mask
+
+# -----------------------------
+# Années de la sélection
+# -----------------------------
+def _is_number(value):
+    return (isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+            and not np.isnan(value))
+
+def _is_whole_number(value):
+    return _is_number(value) and float(value).is_integer()
+
+def _year_intervals(years_input):
+    """
+    Intervalles d'années [(début, fin)] d'une sélection : [1994, 2006],
+    [[1994, 2006]], [(1994, 2006)], liste d'années et/ou de plages.
+    Seul analyseur des années : _extract_years et _year_periods en dérivent.
+    Les entrées non numériques ("20th Century", ...) sont ignorées.
+    """
+    if not isinstance(years_input, list):
+        return []
+    # Cas: [1994, 2006] - plage, ou deux années voisines (même ensemble d'années)
+    if len(years_input) == 2 and all(_is_number(y) for y in years_input):
+        return [(int(min(years_input)), int(max(years_input)))]
+    intervals = []
+    for y in years_input:
+        if isinstance(y, (list, tuple)) and len(y) == 2:
+            intervals.append((int(y[0]), int(y[1])))
+        elif _is_number(y):
+            intervals.append((int(y), int(y)))
+    return intervals
+
+def _extract_years(years_input):
+    """
+    Liste des années d'une sélection (voir _year_intervals).
+    Gère: [1994, 2006], [[1994, 2006]], [(1994, 2006)], "20th Century", etc.
+    """
+    return [year for start, end in _year_intervals(years_input) for year in range(start, end + 1)]
+
+# -----------------------------
+# Index du dataset (construit une fois au démarrage)
+# -----------------------------
+def index_dataset(df):
+    """
+    Précalcule les structures dérivées du dataset utilisées par
+    process_user_selection. Le dictionnaire retourné est passé via le paramètre
+    `index`. Le cube de comptages, l'index spatial et la pyramide de clusters,
+    propres à l'API, sont construits à part (voir backend/app.py).
+    """
+    return {
+        'year_index': build_year_index(df),
+        'country_lists': build_country_lists(df),
+        'year_known': df['year'].notna().to_numpy(),
+        'criteria_cube': build_criteria_cube(df),
+        'range_index': build_range_index(df)
+    }
+
 # -----------------------------
 # Filtrer règles selon critères
 # -----------------------------
 # -----------------------------
 # CORRECTION DE LA FONCTION filter_rules
 # -----------------------------
-def filter_rules(rules, df, years=None, mass_bins=None, continents=None, strict=False):
+def filter_rules(rules, df, years=None, mass_bins=None, continents=None, strict=False, index=None):
     """
     CORRECTION: Ne pas utiliser issubset() qui est trop strict
     Cherche les règles qui contiennent AU MOINS UN des critères
     """
     user_criteria = set()
 
-    # Création du mapping année -> période
-    YEAR_TO_PERIOD = dict(zip(df['year'], df['year_period']))
+    # Index année -> période (construit au démarrage par index_dataset)
+    year_index = index['year_index'] if index else build_year_index(df)
 
     # Années - convertir en format one-hot
     if years:
-        # Détecter si c'est une plage [start, end] ou une liste d'années [1990, 1991, 1992]
-        if len(years) == 2 and all(isinstance(y, (int, float)) for y in years):
-            # C'est probablement une plage [start_year, end_year]
-            start_year, end_year = min(years), max(years)
-            if end_year - start_year > 1:  # C'est une plage
-                for year in df['year'].unique():
-                    if start_year <= year <= end_year:
-                        period = YEAR_TO_PERIOD.get(year)
-                        if period:
-                            user_criteria.add(f'year_period_{period}')
-            else:  # Ce sont juste deux années individuelles
-                for y in years:
-                    if y in YEAR_TO_PERIOD:
-                        user_criteria.add(f'year_period_{YEAR_TO_PERIOD[y]}')
-        else:
-            for y in years:
-                if isinstance(y, (list, tuple)) and len(y) == 2:
-                    # Plage d'années explicite
-                    start_year, end_year = y
-                    for year in df['year'].unique():
-                        if start_year <= year <= end_year:
-                            period = YEAR_TO_PERIOD.get(year)
-                            if period:
-                                user_criteria.add(f'year_period_{period}')
-                elif y in YEAR_TO_PERIOD:
-                    user_criteria.add(f'year_period_{YEAR_TO_PERIOD[y]}')
+        user_criteria.update(f'year_period_{p}' for p in _year_periods(year_index, years))
 
     # Mass bins
     if mass_bins:
@@ -88,86 +931,156 @@ def filter_rules(rules, df, years=None, mass_bins=None, continents=None, strict=
     if continents:
         user_criteria.update(f'continent_{c}' for c in continents)
 
+    # Règles non compilées (appel direct) : encoder les antécédents à la volée ;
+    # process_user_selection compile une seule fois avant ses deux filtrages
+    if 'antecedent_mask' not in rules.columns:
+        rules = compile_rules(rules)
+
     # CORRECTION PRINCIPALE: ne pas utiliser issubset() mais intersection()
-    def match_criteria_corrected(antecedents):
-        ant_set = set(str(item) for item in antecedents)
-        if not user_criteria:
-            return True
+    # Strict = critères inclus dans l'antécédent, sinon au moins un critère commun
+    ant_masks = rules['antecedent_mask'].to_numpy()
+    masks = index.get('masks') if index else None
+    crit_mask, unknown = _criteria_mask(rules.attrs['item_bits'], user_criteria)
+    memo_key = ('antecedent_mask', int(crit_mask), unknown, strict)
+    if masks is not None and memo_key in masks:
+        matched = masks[memo_key]
+    elif not user_criteria:
+        matched = np.ones(len(rules), dtype=bool)
+    else:
         if strict:
-            return user_criteria.issubset(ant_set)
+            if unknown:
+                matched = np.zeros(len(rules), dtype=bool)
+            else:
+                matched = (ant_masks & crit_mask) == crit_mask
         else:
-            return len(ant_set.intersection(user_criteria)) > 0
+            matched = (ant_masks & crit_mask) != 0
+    if masks is not None:
+        masks[memo_key] = matched
 
     # Appliquer le filtrage corrigé
-    filtered = rules[rules['antecedents'].apply(match_criteria_corrected)]
+    filtered = rules[matched]
     
     # Éliminer les tautologies géographiques
-    filtered = filtered[~filtered.apply(is_geographic_tautology, axis=1)]
+    filtered = filtered[~filtered['is_tautology'].to_numpy()]
     
     # Prioriser les règles qui prédissent un type
-    type_rules = filtered[filtered.apply(is_type_prediction_rule, axis=1)]
+    type_rules = filtered[filtered['is_type_rule'].to_numpy()]
     
     # CORRECTION: Si pas de règles de type, prendre quand même d'autres règles
-    # mais les trier par confiance
+    # (déjà triées par confiance depuis compile_rules)
     if not type_rules.empty:
-        return type_rules.sort_values('confidence', ascending=False)
+        return type_rules
     else:
-        return filtered.sort_values('confidence', ascending=False)
+        return filtered
 
 # -----------------------------
 # Obtenir le type le plus probable
 # -----------------------------
-def get_most_probable_type(filtered_rules, df):
+def _consequent_type(consequents):
+    """Type prédit par une règle (sans le préfixe recclass_clean_), None sinon."""
+    for item in consequents:
+        if 'recclass_clean_' in str(item):
+            return str(item).replace('recclass_clean_', '')
+    return None
+
+RANKING_COLUMNS = ['score_sum', 'count', 'max_confidence', 'score', 'share']
+
+def rank_types(filtered_rules):
     """
-    Calcule le type le plus probable basé sur les règles filtrées.
-    Utilise un scoring qui favorise la confidence et le lift.
+    Agrège les règles filtrées par type prédit (np.bincount sur type_code,
+    voir compile_rules). Retourne un DataFrame indexé par type, trié par score
+    décroissant, avec : score_sum, count, max_confidence, score (normalisé)
+    et share (part du score). Égalités : ordre d'apparition dans les règles.
     """
-    type_scores = {}
-    type_max_confidence = {}
-    type_counts = {}
-    
-    if not filtered_rules.empty:
-        # Trier par confidence * lift pour prioriser les meilleures règles
+    if filtered_rules.empty:
+        return pd.DataFrame(columns=RANKING_COLUMNS)
+
+    # Trier par confidence * lift pour prioriser les meilleures règles
+    # (inutile si les règles sortent de compile_rules, déjà triées)
+    if 'type_code' in filtered_rules.columns:
+        sorted_rules = filtered_rules
+        types = sorted_rules['consequent_type'].to_numpy()
+        codes = sorted_rules['type_code'].to_numpy()
+    else:
         sorted_rules = filtered_rules.sort_values(
             by=['confidence', 'lift'], 
             ascending=[False, False]
         )
-        
-        for _, row in sorted_rules.iterrows():
-            for item in row['consequents']:
-                if 'recclass_clean_' in item:
-                    type_name = item.replace('recclass_clean_', '')
-                    
-                    # Score = confidence * lift (le support est déjà filtré en amont)
-                    score = row['confidence'] * row['lift']
-                    type_scores[type_name] = type_scores.get(type_name, 0) + score
-                    
-                    # Garder la meilleure confidence pour ce type
-                    if type_name not in type_max_confidence:
-                        type_max_confidence[type_name] = row['confidence']
-                    else:
-                        type_max_confidence[type_name] = max(type_max_confidence[type_name], row['confidence'])
-                    
-                    type_counts[type_name] = type_counts.get(type_name, 0) + 1
+        types = sorted_rules['consequents'].apply(_consequent_type).to_numpy()
+        codes = pd.factorize(types)[0]
+
+    # Règles sans type prédit ignorées
+    typed = codes >= 0
+    if not typed.all():
+        codes, types = codes[typed], types[typed]
+    if len(codes) == 0:
+        return pd.DataFrame(columns=RANKING_COLUMNS)
+    confidence = sorted_rules['confidence'].to_numpy()[typed].astype(np.float64)
+    lift = sorted_rules['lift'].to_numpy()[typed].astype(np.float64)
+
+    # Types dans l'ordre de première apparition (départage des égalités)
+    present, first, groups = np.unique(codes, return_index=True, return_inverse=True)
+    appearance = np.argsort(first, kind='stable')
+    rank_of = np.empty(len(present), dtype=np.intp)
+    rank_of[appearance] = np.arange(len(present))
+    groups = rank_of[groups]
+
+    # Score = confidence * lift (le support est déjà filtré en amont)
+    score_sum = np.bincount(groups, weights=confidence * lift, minlength=len(present))
+    count = np.bincount(groups, minlength=len(present))
+    max_confidence = np.full(len(present), -np.inf)
+    np.maximum.at(max_confidence, groups, confidence)
+
+    # Normaliser les scores pour éviter que les types avec beaucoup de règles dominent
+    # Score normalisé = score moyen par règle * boost pour confidence max
+    score = score_sum / count * (1 + max_confidence)
+    total = score.sum()
+    share = score / total if total > 0 else np.zeros(len(score))
+    order = np.argsort(-score, kind='stable')
+    return pd.DataFrame({
+        'score_sum': score_sum[order],
+        'count': count[order],
+        'max_confidence': max_confidence[order],
+        'score': score[order],
+        'share': share[order]
+    }, index=pd.Index(types[first[appearance]][order], name='type'))
+
+def type_distribution(ranking):
+    """Distribution classée des types, sérialisable en JSON."""
+    return [
+        {
+            'type': t,
+            'score': round(float(score), 4),
+            'share': round(float(share), 4),
+            'rules': int(count),
+            'max_confidence': round(float(max_confidence), 4)
+        }
+        for t, score, share, count, max_confidence in zip(
+            ranking.index, ranking['score'].to_numpy(), ranking['share'].to_numpy(),
+            ranking['count'].to_numpy(), ranking['max_confidence'].to_numpy())
+    ]
+
+def get_most_probable_type(filtered_rules, df, ranking=None):
+    """
+    Calcule le type le plus probable basé sur les règles filtrées.
+    Utilise un scoring qui favorise la confidence et le lift.
+    `ranking` (voir rank_types) évite de refaire l'agrégation.
+    """
+    if ranking is None:
+        ranking = rank_types(filtered_rules)
+    type_scores = not ranking.empty
     
     if type_scores:
-        # Normaliser les scores pour éviter que les types avec beaucoup de règles dominent
-        normalized_scores = {}
-        for t in type_scores:
-            # Score normalisé = score moyen par règle * boost pour confidence max
-            avg_score = type_scores[t] / type_counts[t]
-            confidence_boost = type_max_confidence[t]
-            normalized_scores[t] = avg_score * (1 + confidence_boost)
-        
-        top_type = max(normalized_scores, key=normalized_scores.get)
+        top_type = ranking.index[0]
         
         # Probabilité = meilleure confidence pour ce type
-        prob = type_max_confidence[top_type]
+        prob = float(ranking['max_confidence'].iloc[0])
+        top_count = int(ranking['count'].iloc[0])
         
         # Bonus si plusieurs règles confirment
-        if type_counts[top_type] >= 3:
+        if top_count >= 3:
             prob = min(prob * 1.1, 0.95)  # Boost de 10% si 3+ règles
-        elif type_counts[top_type] >= 5:
+        elif top_count >= 5:
             prob = min(prob * 1.15, 0.95)  # Boost de 15% si 5+ règles
             
     else:
@@ -191,29 +1104,136 @@ def get_most_probable_type(filtered_rules, df):
 # -----------------------------
 # Prédire valeurs manquantes
 # -----------------------------
-def predict_missing_criteria(df, top_type, user_years=None, user_mass=None, user_continents=None):
+def _mode_label(counts, labels):
+    """Valeur la plus fréquente (la première en cas d'égalité, comme Series.mode), None si aucune."""
+    valid = counts[:len(labels)]
+    if not valid.any():
+        return None
+    return labels[int(np.argmax(valid))]
+
+def _predict_from_cube(cube, top_type, user_years, user_mass, user_continents, range_index=None):
+    """
+    predict_missing_criteria par consultation du cube de comptages (voir
+    build_criteria_cube). Les plages de masse en grammes sont résolues par
+    `range_index`. Retourne None si la sélection n'est pas exprimable ainsi
+    (bornes non numériques, valeurs non hachables, ...) : le dataset est alors filtré.
+    """
+    counts = cube['counts']
+    type_code = cube['types'].get(top_type)
+    if type_code is None:
+        sub = np.zeros(counts.shape[1:], dtype=counts.dtype)
+    else:
+        sub = counts[type_code]
+
+    # Mêmes filtres successifs que le filtrage du dataset : un filtre qui vide
+    # la sélection est ignoré
+    year_mask = None
+    if user_years:
+        if isinstance(user_years, list) and any(
+                isinstance(y, (list, tuple)) and len(y) == 2 and not (_is_number(y[0]) and _is_number(y[1]))
+                for y in user_years):
+            return None
+        # Comparaison vectorisée sur les couples (année, période) : coût indépendant de la largeur
+        pair_year = cube['pair_year']
+        year_mask = np.zeros(sub.shape[0], dtype=bool)
+        for lo, hi in _year_intervals(user_years):
+            year_mask |= (pair_year >= lo) & (pair_year <= hi)
+        narrowed = sub * year_mask[:, None, None]
+        if narrowed.any():
+            sub = narrowed
+        else:
+            year_mask = None
+
+    if user_mass:
+        mass_mask = np.zeros(sub.shape[1], dtype=bool)
+        ranges = []
+        for m in (user_mass if isinstance(user_mass, list) else [user_mass]):
+            if isinstance(m, (list, tuple)):
+                if range_index is None or len(m) != 2 or not (_is_number(m[0]) and _is_number(m[1])):
+                    return None
+                ranges.append((m[0], m[1]))
+                continue
+            if not isinstance(m, Hashable):
+                return None
+            code = cube['mass_codes'].get(m)
+            if code is not None:
+                mass_mask[code] = True
+        narrowed = sub * mass_mask[None, :, None]
+        if ranges and type_code is not None:
+            # Lignes du type dans les plages de masse (hors classes déjà comptées)
+            rows = _range_rows(range_index, 'mass_cleaned', ranges, top_type)
+            pair_codes, mass_codes, continent_codes = (codes[rows] for codes in cube['row_codes'])
+            keep = ~mass_mask[mass_codes]
+            if year_mask is not None:
+                keep &= year_mask[pair_codes]
+            cells = np.ravel_multi_index((pair_codes[keep], mass_codes[keep], continent_codes[keep]), narrowed.shape)
+            narrowed = narrowed + np.bincount(cells, minlength=narrowed.size).reshape(narrowed.shape)
+        if narrowed.any():
+            sub = narrowed
+
+    if user_continents:
+        cont_mask = np.zeros(sub.shape[2], dtype=bool)
+        for c in (user_continents if isinstance(user_continents, list) else [user_continents]):
+            if c is None or not isinstance(c, Hashable) or (isinstance(c, float) and np.isnan(c)):
+                return None
+            code = cube['continent_codes'].get(c)
+            if code is not None:
+                cont_mask[code] = True
+        narrowed = sub * cont_mask[None, None, :]
+        if narrowed.any():
+            sub = narrowed
+
+    # Type absent du dataset : fallback sur le dataset entier
+    if not sub.any():
+        sub = cube['overall']
+
+    if user_years:
+        year_pred = user_years
+    else:
+        period_counts = np.bincount(cube['pair_period'], weights=sub.sum(axis=(1, 2)),
+                                    minlength=len(cube['periods']) + 1)
+        year_pred = _mode_label(period_counts, cube['periods'])
+        if year_pred is None:
+            return None
+
+    if user_mass:
+        mass_pred = user_mass if isinstance(user_mass, list) else [user_mass]
+    else:
+        mass_pred = _mode_label(sub.sum(axis=(0, 2)), cube['masses'])
+        if mass_pred is None:
+            return None
+        mass_pred = [mass_pred]
+
+    if user_continents:
+        continent_pred = user_continents if isinstance(user_continents, list) else [user_continents]
+    else:
+        continent_pred = _mode_label(sub.sum(axis=(0, 1)), cube['continents'])
+        if continent_pred is None:
+            return None
+        continent_pred = [continent_pred]
+
+    return year_pred, mass_pred, continent_pred
+
+def predict_missing_criteria(df, top_type, user_years=None, user_mass=None, user_continents=None, index=None):
     """
     Prédit les critères manquants basés sur le type de météorite.
     Ne retourne JAMAIS None - utilise des fallbacks sur le dataset global.
+    Avec `index` (voir index_dataset), les modes sont lus dans le cube de
+    comptages précalculé au lieu de filtrer le dataset.
     """
+    index = index or {}
+    cube = index.get('criteria_cube')
+    if cube is not None:
+        predicted = _predict_from_cube(cube, top_type, user_years, user_mass, user_continents,
+                                       index.get('range_index'))
+        if predicted is not None:
+            return predicted
+
     df_type = df[df['recclass_clean'] == top_type].copy()
     
     # Filtrer par années si fournies
     if user_years:
-        years_flat = []
-        # Détecter si c'est une plage [start, end]
-        if len(user_years) == 2 and all(isinstance(y, (int, float)) for y in user_years):
-            start_year, end_year = min(user_years), max(user_years)
-            if end_year - start_year > 1:
-                years_flat = list(range(int(start_year), int(end_year) + 1))
-            else:
-                years_flat = [int(y) for y in user_years]
-        else:
-            for y in user_years:
-                if isinstance(y, (list, tuple)) and len(y) == 2:
-                    years_flat.extend(range(int(y[0]), int(y[1]) + 1))
-                else:
-                    years_flat.append(int(y) if isinstance(y, float) else y)
+        years_flat = _extract_years(user_years)
         df_filtered = df_type[df_type['year'].isin(years_flat)]
         if not df_filtered.empty:
             df_type = df_filtered
@@ -286,121 +1306,235 @@ def predict_missing_criteria(df, top_type, user_years=None, user_mass=None, user
 # Infos selon critères
 # -----------------------------
 def get_type_info(df, top_type, user_years=None, user_mass=None, user_continents=None,
-                  pred_year=None, pred_mass=None, pred_continent=None):
+                  pred_year=None, pred_mass=None, pred_continent=None, masks=None, limit=None,
+                  sample='first', index=None):
     """
     Récupère les informations sur les météorites correspondant au type et aux critères.
     Les critères UTILISATEUR sont OBLIGATOIRES et ne sont jamais assouplis.
+    Chaque comparaison de colonne est calculée une seule fois ; les étapes de
+    repli combinent ces masques sans recopier le dataset.
+    `masks` (dict) partage les comparaisons entre les sélections d'un même lot.
+    `limit` borne les listes `names` et `sample_years` (None = listes complètes) :
+    seules ces lignes sont extraites. `sample='stratified'` répartit les exemples
+    entre les pays au lieu de prendre les premières lignes.
+    `index` (voir index_dataset) fournit les listes de pays précalculées.
+    Retourne (names, countries, sample_years, mass_bin, masque des lignes retenues).
     """
-    # ÉTAPE 1: Commencer avec le type prédit
-    df_result = df[df['recclass_clean'] == top_type].copy()
-    
-    # ÉTAPE 2: Appliquer les critères UTILISATEUR (OBLIGATOIRES - jamais assouplis)
+    index = index or {}
+    type_mask = _isin_mask(df, 'recclass_clean', [top_type], masks)
+
+    # Masques des critères UTILISATEUR (None = critère absent)
+    cont_mask = None
+    cont_list = None
     if user_continents:
         cont_list = user_continents if isinstance(user_continents, list) else [user_continents]
-        df_result = df_result[df_result['continent'].isin(cont_list)]
-    
+        cont_mask = _isin_mask(df, 'continent', cont_list, masks)
+
+    range_index = index.get('range_index')
+    years_mask = None
     if user_years:
-        years_flat = _extract_years(user_years)
-        if years_flat:
-            df_result = df_result[df_result['year'].isin(years_flat)]
-    
-    if user_mass:
-        mass_mask = pd.Series(False, index=df_result.index)
-        mass_list = user_mass if isinstance(user_mass, list) else [user_mass]
-        for m in mass_list:
-            if isinstance(m, (list, tuple)) and len(m) == 2:
-                mass_mask |= df_result['mass_cleaned'].between(m[0], m[1])
-            else:
-                mass_mask |= (df_result['mass_bin'] == m)
-        df_result = df_result[mass_mask]
-    
-    # ÉTAPE 3: Si vide après critères utilisateur, chercher DANS LE CONTINENT demandé avec un autre type
-    if df_result.empty and user_continents:
-        # Garder le continent mais ignorer le type
-        df_result = df.copy()
-        cont_list = user_continents if isinstance(user_continents, list) else [user_continents]
-        df_result = df_result[df_result['continent'].isin(cont_list)]
-        
-        # Appliquer les autres critères utilisateur si fournis
-        if user_years:
+        if range_index is not None:
+            # Intervalles d'années : recherches binaires au lieu d'isin sur la liste des années
+            intervals = [(lo, hi) for lo, hi in _year_intervals(user_years) if lo <= hi]
+            if intervals:
+                years_mask = _range_mask(range_index, 'year', intervals, masks)
+        else:
             years_flat = _extract_years(user_years)
             if years_flat:
-                df_temp = df_result[df_result['year'].isin(years_flat)]
-                if not df_temp.empty:
-                    df_result = df_temp
-        
-        if user_mass:
-            mass_mask = pd.Series(False, index=df_result.index)
-            mass_list = user_mass if isinstance(user_mass, list) else [user_mass]
-            for m in mass_list:
-                if isinstance(m, (list, tuple)) and len(m) == 2:
-                    mass_mask |= df_result['mass_cleaned'].between(m[0], m[1])
-                else:
-                    mass_mask |= (df_result['mass_bin'] == m)
-            df_temp = df_result[mass_mask]
-            if not df_temp.empty:
-                df_result = df_temp
-    
+                years_mask = _isin_mask(df, 'year', years_flat, masks)
+
+    mass_mask = _mass_mask(df, user_mass, masks, range_index) if user_mass else None
+
+    pred_cont_mask = None
+    pred_cont_list = None
+    if pred_continent:
+        pred_cont_list = pred_continent if isinstance(pred_continent, list) else [pred_continent]
+        pred_cont_mask = _isin_mask(df, 'continent', pred_cont_list, masks)
+
+    # `lookup` : (type, continents) si le masque retenu n'est qu'un filtre
+    # type / continent (pays précalculés utilisables), sinon None
+
+    # ÉTAPE 1-2: Type prédit + critères UTILISATEUR (OBLIGATOIRES - jamais assouplis)
+    result_mask = type_mask
+    for mask in (cont_mask, years_mask, mass_mask):
+        if mask is not None:
+            result_mask = result_mask & mask
+    lookup = (top_type, cont_list) if years_mask is None and mass_mask is None else None
+
+    # ÉTAPE 3: Si vide après critères utilisateur, chercher DANS LE CONTINENT demandé avec un autre type
+    if not result_mask.any() and cont_mask is not None:
+        # Garder le continent mais ignorer le type
+        result_mask = cont_mask
+        lookup = (None, cont_list)
+        # Appliquer les autres critères utilisateur si fournis (seulement s'ils gardent des lignes)
+        for mask in (years_mask, mass_mask):
+            if mask is not None:
+                narrowed = result_mask & mask
+                if narrowed.any():
+                    result_mask = narrowed
+                    lookup = None
+
     # ÉTAPE 4: Si l'utilisateur n'a PAS donné de continent, utiliser le continent PRÉDIT comme filtre
-    if not user_continents and pred_continent:
-        cont_list = pred_continent if isinstance(pred_continent, list) else [pred_continent]
-        df_temp = df_result[df_result['continent'].isin(cont_list)]
-        if not df_temp.empty:
-            df_result = df_temp
-    
+    if not user_continents and pred_cont_mask is not None:
+        narrowed = result_mask & pred_cont_mask
+        if narrowed.any():
+            result_mask = narrowed
+            lookup = (lookup[0], pred_cont_list) if lookup is not None else None
+
     # ÉTAPE 5: Si toujours vide, fallback sur le type seul avec continent prédit
-    if df_result.empty:
-        df_result = df[df['recclass_clean'] == top_type].copy()
-        if pred_continent:
-            cont_list = pred_continent if isinstance(pred_continent, list) else [pred_continent]
-            df_temp = df_result[df_result['continent'].isin(cont_list)]
-            if not df_temp.empty:
-                df_result = df_temp
+    if not result_mask.any():
+        result_mask = type_mask
+        lookup = (top_type, None)
+        if pred_cont_mask is not None:
+            narrowed = type_mask & pred_cont_mask
+            if narrowed.any():
+                result_mask = narrowed
+                lookup = (top_type, pred_cont_list)
 
-    names = df_result['name'].tolist() if not df_result.empty else []
-    countries = df_result['country'].dropna().unique().tolist() if not df_result.empty else []
-    sample_years = df_result['year'].dropna().tolist() if not df_result.empty else []
-    mass_bin = df_result['mass_bin'].mode()[0] if not df_result.empty and len(df_result['mass_bin'].mode()) > 0 else None
+    if not result_mask.any():
+        return [], [], [], None, result_mask
 
-    return names, countries, sample_years, mass_bin, df_result
+    # Exemples : seules les lignes retournées sont extraites
+    if sample == 'stratified':
+        rows = _stratified_rows(df, np.flatnonzero(result_mask), limit)
+        names = df['name'].take(rows).tolist()
+        sample_years = df['year'].take(rows).dropna().tolist()
+    else:
+        names = df['name'].take(np.flatnonzero(result_mask)[:limit]).tolist()
+        year_known = index.get('year_known')
+        if year_known is None:
+            year_known = df['year'].notna().to_numpy()
+        sample_years = df['year'].take(np.flatnonzero(result_mask & year_known)[:limit]).tolist()
 
+    # Pays distincts : listes précalculées quand le masque n'est qu'un filtre type / continent
+    country_lists = index.get('country_lists')
+    if country_lists is not None and lookup is not None:
+        countries = _lookup_countries(country_lists, *lookup)
+    else:
+        countries = df['country'][result_mask].dropna().unique().tolist()
 
-def _extract_years(years_input):
+    mass_mode = df['mass_bin'][result_mask].mode()
+    mass_bin = mass_mode[0] if len(mass_mode) > 0 else None
+
+    return names, countries, sample_years, mass_bin, result_mask
+
+
+def _stratified_rows(df, rows, limit):
     """
-    Extrait une liste d'années à partir de différents formats d'entrée.
-    Gère: [1994, 2006], [[1994, 2006]], [(1994, 2006)], "20th Century", etc.
+    Positions `rows` réordonnées pour alterner entre pays (premier exemple de chaque
+    pays dans l'ordre d'apparition, puis le deuxième, ...), tronquées à `limit`.
     """
-    if years_input is None:
-        return []
-    
-    # Si c'est une période (string)
-    if isinstance(years_input, str):
-        return []  # Sera traité par year_period
-    
-    years_flat = []
-    
-    # Si c'est une liste
-    if isinstance(years_input, list):
-        # Cas: [[1994, 2006]] ou [(1994, 2006)] - liste contenant une plage
-        if len(years_input) == 1 and isinstance(years_input[0], (list, tuple)) and len(years_input[0]) == 2:
-            start, end = years_input[0]
-            years_flat = list(range(int(start), int(end) + 1))
-        # Cas: [1994, 2006] - pourrait être une plage ou deux années
-        elif len(years_input) == 2 and all(isinstance(y, (int, float)) for y in years_input):
-            start, end = min(years_input), max(years_input)
-            if end - start > 1:  # C'est une plage
-                years_flat = list(range(int(start), int(end) + 1))
-            else:  # Deux années individuelles
-                years_flat = [int(y) for y in years_input]
-        # Cas: liste d'années ou de plages
+    codes, _ = pd.factorize(df['country'].take(rows).to_numpy())
+    # Lignes sans pays en dernier
+    codes = np.where(codes < 0, codes.max() + 1, codes)
+    rank = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+    return rows[np.lexsort((codes, rank))][:limit]
+
+
+def _isin_mask(df, column, values, masks=None):
+    """
+    Masque df[column].isin(values), mémorisé dans `masks` si fourni
+    (comparaisons partagées entre les sélections d'un même lot).
+    """
+    if masks is None:
+        return df[column].isin(values).to_numpy()
+    try:
+        key = (column, tuple(values))
+        mask = masks.get(key)
+    except TypeError:
+        return df[column].isin(values).to_numpy()
+    if mask is None:
+        mask = masks[key] = df[column].isin(values).to_numpy()
+    return mask
+
+def _mass_mask(df, user_mass, masks=None, range_index=None):
+    """
+    Masque des lignes correspondant à la sélection de masse :
+    classes ('1-10g', ...) ou plages [min, max] en grammes
+    (recherches binaires si `range_index` est fourni).
+    """
+    mass_mask = np.zeros(len(df), dtype=bool)
+    mass_list = user_mass if isinstance(user_mass, list) else [user_mass]
+    for m in mass_list:
+        if isinstance(m, (list, tuple)) and len(m) == 2:
+            if range_index is not None and _is_number(m[0]) and _is_number(m[1]):
+                mass_mask |= _range_mask(range_index, 'mass_cleaned', [(m[0], m[1])], masks)
+            else:
+                mass_mask |= df['mass_cleaned'].between(m[0], m[1]).to_numpy()
         else:
-            for y in years_input:
-                if isinstance(y, (list, tuple)) and len(y) == 2:
-                    years_flat.extend(range(int(y[0]), int(y[1]) + 1))
-                elif isinstance(y, (int, float)):
-                    years_flat.append(int(y))
-    
-    return years_flat
+            mass_mask |= _isin_mask(df, 'mass_bin', [m], masks)
+    return mass_mask
+
+
+# -----------------------------
+# Clé canonique d'une sélection
+# -----------------------------
+def _raw_key(value):
+    """Clé de repli : forme brute (hashable) de la valeur fournie."""
+    if isinstance(value, (list, tuple)):
+        return ('raw',) + tuple(_raw_key(v) if isinstance(v, (list, tuple)) else v for v in value)
+    return ('raw', value)
+
+def _years_key(years):
+    """
+    Années canoniques : plages contiguës (start, end) des années extraites.
+    [1990, 2000], [[1990, 2000]] et la liste des 11 années donnent la même clé.
+    Les entrées non entières (bornes décimales, périodes texte) gardent leur forme brute.
+    """
+    if not years:
+        return None
+    if not isinstance(years, list):
+        return _raw_key(years)
+    values = [v for y in years for v in (y if isinstance(y, (list, tuple)) else [y])]
+    if not values or not all(_is_whole_number(v) for v in values):
+        return _raw_key(years)
+    years_flat = sorted(set(_extract_years(years)))
+    if not years_flat:
+        return _raw_key(years)
+    runs = []
+    start = prev = years_flat[0]
+    for y in years_flat[1:]:
+        if y != prev + 1:
+            runs.append((start, prev))
+            start = y
+        prev = y
+    runs.append((start, prev))
+    return tuple(runs)
+
+def _mass_key(mass):
+    """Masses canoniques : classes et plages [min, max] triées, sans doublons."""
+    if not mass:
+        return None
+    if not isinstance(mass, list):
+        return _raw_key(mass)
+    items = set()
+    for m in mass:
+        if isinstance(m, (list, tuple)) and len(m) == 2:
+            items.add(('range', float(m[0]), float(m[1])))
+        elif isinstance(m, str):
+            items.add(('bin', m))
+        else:
+            return _raw_key(mass)
+    return tuple(sorted(items))
+
+def _continents_key(continents):
+    """Continents canoniques : liste triée sans doublons."""
+    if not continents:
+        return None
+    if not isinstance(continents, list) or not all(isinstance(c, str) for c in continents):
+        return _raw_key(continents)
+    return tuple(sorted(set(continents)))
+
+def selection_key(sel):
+    """
+    Clé hashable d'une sélection utilisateur : deux sélections de même clé
+    donnent le même résultat de process_user_selection.
+    """
+    return (
+        _years_key(sel.get('years')),
+        _mass_key(sel.get('mass')),
+        _continents_key(sel.get('continents'))
+    )
 
 # -----------------------------
 # Statistiques de qualité des règles
@@ -415,7 +1549,10 @@ def get_rules_statistics(filtered_rules):
             'mean_lift': 0
         }
     
-    type_rules = filtered_rules[filtered_rules.apply(is_type_prediction_rule, axis=1)]
+    if 'is_type_rule' in filtered_rules.columns:
+        type_rules = filtered_rules[filtered_rules['is_type_rule'].to_numpy()]
+    else:
+        type_rules = filtered_rules[filtered_rules.apply(is_type_prediction_rule, axis=1)]
     
     return {
         'total': len(filtered_rules),
@@ -428,46 +1565,82 @@ def get_rules_statistics(filtered_rules):
 # -----------------------------
 # Traitement d'une sélection utilisateur
 # -----------------------------
-def process_user_selection(sel, rules, df):
+def _lap(timings, stage, start):
+    """Ajoute la durée écoulée depuis `start` à timings[stage] et retourne l'instant courant."""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + (now - start)
+    return now
+
+# Nombre d'exemples (noms, années) retournés par défaut
+EXAMPLES_LIMIT = 20
+
+def process_user_selection(sel, rules, df, index=None, timings=None, max_examples=EXAMPLES_LIMIT,
+                           sample='first', examples=True):
     """
     Traite la sélection utilisateur pour prédire le type de météorite.
     Utilise d'abord un filtrage non-strict, puis strict si trop de résultats.
+    `index` (voir index_dataset) évite de recalculer les structures du dataset.
+    `timings` (dict), si fourni, reçoit la durée en secondes de chaque étape.
+    `max_examples` : taille maximale des listes `names` et `sample_years`.
+    `sample` : 'first' (premières lignes) ou 'stratified' (réparties entre les pays).
+    `examples=False` saute le filtrage du dataset (names, countries et
+    sample_years vides) quand la réponse n'en contient aucun (voir EXAMPLE_FIELDS).
     """
+    if index is None:
+        index = index_dataset(df)
+    t = time.perf_counter()
+
+    # Règles non compilées (ex: notebook) : compiler une fois pour les deux filtrages
+    if 'antecedent_mask' not in rules.columns:
+        rules = compile_rules(rules)
+
     # Récupérer les critères utilisateur
     years = sel.get('years') or []
     mass = sel.get('mass') or []
     continents = sel.get('continents') or []
 
     # D'abord essayer le mode strict
-    filtered_rules = filter_rules(rules, df, years, mass, continents, strict=True)
+    filtered_rules = filter_rules(rules, df, years, mass, continents, strict=True, index=index)
     
     # Si pas assez de règles en mode strict, passer en mode non-strict
     if len(filtered_rules) < 3:
-        filtered_rules = filter_rules(rules, df, years, mass, continents, strict=False)
+        filtered_rules = filter_rules(rules, df, years, mass, continents, strict=False, index=index)
     
     # Ne garder que les règles de qualité (lift >= 1)
     if not filtered_rules.empty:
         quality_rules = filtered_rules[filtered_rules['lift'] >= 1.0]
         if not quality_rules.empty:
             filtered_rules = quality_rules
+    t = _lap(timings, 'filter_rules', t)
     
-    top_type, prob = get_most_probable_type(filtered_rules, df)
+    ranking = rank_types(filtered_rules)
+    top_type, prob = get_most_probable_type(filtered_rules, df, ranking=ranking)
+    t = _lap(timings, 'get_most_probable_type', t)
 
     # Prédire les critères manquants
     year_pred, mass_pred, continent_pred = predict_missing_criteria(
-        df, top_type, years if years else None, mass if mass else None, continents if continents else None
+        df, top_type, years if years else None, mass if mass else None, continents if continents else None,
+        index=index
     )
+    t = _lap(timings, 'predict_missing_criteria', t)
 
     # Filtrer le dataset selon le type et les critères/prédictions
-    names, countries, sample_years, mass_bin, df_points = get_type_info(
-        df, top_type, years if years else None, mass if mass else None, continents if continents else None,
-        year_pred, mass_pred, continent_pred
-    )
+    # ("OTHER" en a besoin pour afficher le recclass le plus fréquent)
+    if examples or top_type == "OTHER":
+        names, countries, sample_years, mass_bin, points = get_type_info(
+            df, top_type, years if years else None, mass if mass else None, continents if continents else None,
+            year_pred, mass_pred, continent_pred, masks=index.get('masks'), limit=max_examples,
+            sample=sample, index=index
+        )
+        t = _lap(timings, 'get_type_info', t)
+    else:
+        names, countries, sample_years = [], [], []
 
     # Si le type prédit est "OTHER", afficher le recclass le plus fréquent
     display_type = top_type
-    if top_type == "OTHER" and not df_points.empty:
-        mode_result = df_points['recclass'].mode()
+    if top_type == "OTHER" and points.any():
+        mode_result = df['recclass'][points].mode()
         display_type = mode_result[0] if len(mode_result) > 0 else top_type
 
     # Construire le résultat avec seulement les valeurs PRÉDITES (non fournies par l'utilisateur)
@@ -476,9 +1649,10 @@ def process_user_selection(sel, rules, df):
         'filtered_rules': filtered_rules,
         'top_type': display_type,
         'probability': round(prob, 4),
-        'names': names[:20] if len(names) > 20 else names,
+        'names': names,
         'countries': countries,
-        'sample_years': sample_years[:20] if len(sample_years) > 20 else sample_years,
+        'sample_years': sample_years,
+        'type_distribution': type_distribution(ranking),
         'rules_count': len(filtered_rules),
         'rules_quality': get_rules_statistics(filtered_rules)
     }
@@ -496,6 +1670,82 @@ def process_user_selection(sel, rules, df):
     return result
     
 
+# Champs possibles d'une réponse de l'API
+RESPONSE_FIELDS = ('top_type', 'probability', 'names', 'countries', 'sample_years', 'type_distribution',
+                   'predicted_years', 'predicted_mass', 'predicted_continent')
+# Listes d'exemples paginées par offset / limit
+PAGED_FIELDS = ('names', 'sample_years')
+# Champs issus du filtrage du dataset (get_type_info)
+EXAMPLE_FIELDS = ('names', 'countries', 'sample_years')
+
+def build_response(result, fields=None, offset=0, limit=None):
+    """
+    Réponse JSON de l'API construite à partir du résultat de process_user_selection.
+    `fields` restreint la réponse à ces champs ; `offset` / `limit` paginent
+    les listes d'exemples (names, sample_years).
+    """
+    # Construire la réponse de base
+    response = {
+        'top_type': result['top_type'],
+        'probability': result['probability'],
+        'names': result['names'],
+        'countries': result['countries'],
+        'sample_years': result['sample_years'],
+        'type_distribution': result['type_distribution']
+    }
+    
+    # Toujours ajouter les prédictions - elles ne seront jamais None
+    for field in ('predicted_years', 'predicted_mass', 'predicted_continent'):
+        if field in result:
+            response[field] = result[field]
+
+    if fields is not None:
+        response = {field: value for field, value in response.items() if field in fields}
+    if offset or limit is not None:
+        end = None if limit is None else offset + limit
+        for field in PAGED_FIELDS:
+            if field in response:
+                response[field] = response[field][offset:end]
+    
+    return response
+
+
+# -----------------------------
+# Table de réponses précalculées
+# -----------------------------
+def file_digest(*paths):
+    """Empreinte (sha256 tronqué) du contenu des fichiers donnés."""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+def enumerate_selections(df):
+    """
+    Toutes les sélections discrétisées : période (plage d'années couverte
+    par le dataset), classe de masse et continent, chacun optionnel.
+    """
+    spans = df.dropna(subset=['year']).groupby('year_period', observed=True)['year'].agg(['min', 'max'])
+    year_opts = [None] + [[[int(lo), int(hi)]] for lo, hi in spans.itertuples(index=False)]
+    mass_opts = [None] + [[m] for m in sorted(df['mass_bin'].dropna().unique())]
+    cont_opts = [None] + [[c] for c in sorted(df['continent'].dropna().unique())]
+    for years, mass, continents in itertools.product(year_opts, mass_opts, cont_opts):
+        yield {'years': years, 'mass': mass, 'continents': continents}
+
+def build_answer_table(rules, df, index=None):
+    """
+    Évalue process_user_selection pour chaque sélection discrétisée.
+    Retourne {selection_key: résultat (sans le DataFrame des règles filtrées)}.
+    """
+    if index is None:
+        index = index_dataset(df)
+    answers = {}
+    for sel in enumerate_selections(df):
+        result = process_user_selection(sel, rules, df, index=index)
+        answers[selection_key(sel)] = {k: v for k, v in result.items() if k != 'filtered_rules'}
+    return answers
 
 
 # -----------------------------